@@ -1,8 +1,9 @@
 import torch
 import torch.nn as nn
-from safetensors.torch import load_file
-from .feature_extractor import FeatureExtractor, FeatureExtractorException
-import json
+import torch.nn.functional as F
+from .feature_extractor import FeatureExtractor, FeatureExtractorException, PRECISIONS, default_device
+from .instrumentation import Stats
+import json, heapq, os, mmap
 
 def to_bool(s): 
     if isinstance(s,str): return (s=="True")
@@ -18,17 +19,33 @@ def to_float_list(s):
     if isinstance(s,str): return list(float(x) for x in s[1:-1].split(',') if x)
     if isinstance(s,list): return s
     raise NotImplementedError()
+
+def linear_layers(module:nn.Module) -> list:
+    return list(m for m in module if hasattr(m, "in_features"))
+
+def linear_weight_and_bias(m) -> tuple:
+    '''
+    The weight and bias of an nn.Linear, or (dequantized) of a dynamically quantized Linear
+    '''
+    if callable(m.weight): return m.weight().dequantize(), m.bias()
+    return m.weight.detach(), (m.bias.detach() if m.bias is not None else None)
     
+SAFETENSORS_DTYPES = { "F64":torch.float64, "F32":torch.float32, "F16":torch.float16, "BF16":torch.bfloat16, 
+                       "I64":torch.int64, "I32":torch.int32, "I16":torch.int16, "I8":torch.int8, "U8":torch.uint8, "BOOL":torch.bool }
+
 class AestheticPredictor(nn.Module):
+    headers = {} # path -> ((mtime, size), header length, header)
+
     @classmethod
     def from_pretrained(cls, pretrained:str, **feargs):
         metadata, _ = cls.load_metadata_and_sd(pretrained=pretrained, return_sd=False)
         feature_extractor = FeatureExtractor.get_feature_extractor(pretrained=metadata["feature_extractor_model"], ap_metadata=metadata, **feargs)
-        return AestheticPredictor(feature_extractor=feature_extractor, pretrained=pretrained)
+        return AestheticPredictor(feature_extractor=feature_extractor, pretrained=pretrained, device=feargs.get("device", None), 
+                                  precision=feargs.get("precision", "fp32"))
     
     @classmethod
-    def no_feature_extractor(cls, pretrained:str):
-        return AestheticPredictor(feature_extractor=None, pretrained=pretrained)
+    def no_feature_extractor(cls, pretrained:str, device=None):
+        return AestheticPredictor(feature_extractor=None, pretrained=pretrained, device=device)
     
     def precache(self, image_filepaths:list):
         self.feature_extractor.precache(image_filepaths)
@@ -39,13 +56,23 @@ class AestheticPredictor(nn.Module):
         self.device = device
         return self
     
+    def managed_modules(self, include_feature_extractor=True) -> list:
+        modules = [self,] if self.precision!="int8" else []
+        if include_feature_extractor and self.feature_extractor: modules += self.feature_extractor.managed_modules()
+        return modules
+
+    def resident_modules(self, include_feature_extractor=True) -> list:
+        modules = [self,]
+        if include_feature_extractor and self.feature_extractor: modules += self.feature_extractor.resident_modules()
+        return modules
+    
     def _get_argument(self, p:str, default, cast:callable):
         value = self.metadata[p] if p in self.metadata else (self.kwargs[p] if p in self.kwargs else default)
         if value is None: raise Exception(f"No value found for {p}")
         self.metadata[p] = str(value)
         return cast(value)
 
-    def __init__(self, feature_extractor:FeatureExtractor=None, pretrained="", device="cuda", model_seed=None, **kwargs):  
+    def __init__(self, feature_extractor:FeatureExtractor=None, pretrained="", device=None, model_seed=None, precision="fp32", **kwargs):  
         super().__init__()
         
         self.metadata, sd = self.load_metadata_and_sd(pretrained)
@@ -83,8 +110,31 @@ class AestheticPredictor(nn.Module):
         self.main_process.append(nn.Dropout(self.dropouts[-1] if self.dropouts else 0.0))
         self.main_process.append(nn.Linear(current_size, self.output_channels, bias=self.final_layer_bias))
 
-        if sd: self.load_state_dict(sd)
-        self.to(device)
+        if sd: self.load_state_dict(sd, assign=True)
+        self.to(device or (feature_extractor.device if feature_extractor else default_device()))
+        self.set_precision(precision)
+        self._unmap(sd)
+
+    def _unmap(self, sd:dict):
+        '''
+        Copy any parameters and buffers still backed by the memory map of the .safetensors file (those that stayed on the
+        CPU at the dtype they were saved in), so the model doesn't depend on the file - which may be rewritten or truncated
+        '''
+        mapped = set(t.untyped_storage().data_ptr() for t in sd.values() if t.numel())
+        for t in list(self.parameters()) + list(self.buffers()):
+            if t.numel() and t.untyped_storage().data_ptr() in mapped: t.data = t.data.clone()
+
+    def set_precision(self, precision:str):
+        '''
+        Convert the head to fp32, fp16, bf16 or int8 (dynamic quantization of the Linear layers, CPU only)
+        '''
+        if precision not in PRECISIONS: raise FeatureExtractorException(f"Unknown precision {precision}")
+        if precision=="int8" and str(self.device)!="cpu": raise FeatureExtractorException("int8 precision is only available on the CPU")
+        self.precision = precision
+        self.dtype = PRECISIONS[precision]
+        if precision=="int8": torch.ao.quantization.quantize_dynamic(self, {nn.Linear}, dtype=torch.qint8, inplace=True)
+        else: super().to(self.dtype)
+        return self
 
     def info(self):
         if self.preprocess:
@@ -93,35 +143,74 @@ class AestheticPredictor(nn.Module):
             return { "normalised_hidden_layer_projection" : ",".join("{:>8.4f}".format(x.item()/last) for x in ws) }
         return {}
 
+    @classmethod
+    def read_header(cls, pretrained) -> tuple:
+        '''
+        Read just the header of a .safetensors file, cached by (path, mtime, size). Returns (header length, header)
+        '''
+        path = os.path.abspath(pretrained)
+        stat = os.stat(path)
+        if path not in cls.headers or cls.headers[path][0]!=(stat.st_mtime_ns, stat.st_size):
+            with open(path, "rb") as f:
+                n = int.from_bytes(f.read(8), "little")
+                cls.headers[path] = ((stat.st_mtime_ns, stat.st_size), n, json.loads(f.read(n)))
+        return cls.headers[path][1:]
+
+    @classmethod
+    def map_state_dict(cls, pretrained) -> dict:
+        '''
+        The tensors of a .safetensors file as views of a (copy on write) memory map of it, so nothing is read or copied 
+        until it is used (AestheticPredictor copies any that are still mapped once it is built)
+        '''
+        n, header = cls.read_header(pretrained)
+        with open(pretrained, "rb") as f:
+            buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+        sd = {}
+        for name, info in header.items():
+            if name=="__metadata__": continue
+            start, end = info["data_offsets"]
+            dtype = SAFETENSORS_DTYPES[info["dtype"]]
+            if end==start: sd[name] = torch.empty(info["shape"], dtype=dtype)
+            else: sd[name] = torch.frombuffer(buffer, dtype=dtype, count=(end-start)//dtype.itemsize, offset=8+n+start).reshape(info["shape"])
+        return sd
+
     @classmethod
     def load_metadata_and_sd(cls, pretrained, return_sd=True):
         if pretrained:
-            with open(pretrained, "rb") as f:
-                data = f.read()
-                n_header = data[:8]
-            n = int.from_bytes(n_header, "little")
-            metadata_bytes = data[8 : 8 + n]
-            header = json.loads(metadata_bytes)
-            return header.get("__metadata__", {}), load_file(pretrained) if return_sd else {}
+            _, header = cls.read_header(pretrained)
+            return dict(header.get("__metadata__", {})), cls.map_state_dict(pretrained) if return_sd else {}
         else:
             return {}, {}
         
     def get_metadata(self): return self.metadata
 
     def forward(self, x, **kwargs):
+        x = x.to(self.dtype)
         if self.preprocess:
             xp = self.preprocess(x.permute((0,2,1)))
             xp = xp.reshape((x.shape[0],-1))
         else:
             xp = x
-        return self.main_process(xp)
+        return self.main_process(xp).float()
         
+    def compiled_head(self) -> 'CompiledHead':
+        return CompiledHead(self)
+
     def evaluate_image(self, img):
         return self(self.feature_extractor._get_image_features_tensor(img).to(self.device))
     
+    def evaluate_images(self, images:torch.Tensor, batch_size=8):
+        '''
+        Score a [B,H,W,C] IMAGE tensor, with one backbone and one head pass per chunk of batch_size images
+        '''
+        batch_size = batch_size or len(images)
+        with torch.no_grad():
+            features = self.feature_extractor.get_image_features_batch(images, batch_size=batch_size)
+            with Stats.timer("head"): return torch.cat(list(self(features[i:i+batch_size].to(self.device)) for i in range(0, len(features), batch_size)))
+    
     def evaluate_files(self, files, as_sorted_tuple=False, output_value=0):
         def score_files(fs):
-            data = torch.stack(list(self.feature_extractor.get_features_from_file(f) for f in fs))
+            data = torch.stack(list(self.feature_extractor.get_features_from_file(f, device=self.device) for f in fs))
             return self(data)[:,output_value] if output_value is not None else self(data)
         
         scores = score_files(files).cpu()
@@ -131,11 +220,161 @@ class AestheticPredictor(nn.Module):
             scores.sort()
 
         return scores
+    
+    @staticmethod
+    def drift(scores:torch.Tensor, reference:torch.Tensor) -> str:
+        '''
+        Describe how far scores (from a reduced precision model) are from the reference (fp32) scores
+        '''
+        difference = (scores.float().cpu() - reference.float().cpu()).abs()
+        moved = (torch.argsort(scores.flatten().cpu(), stable=True) != torch.argsort(reference.flatten().cpu(), stable=True)).sum()
+        return f"drift from fp32: max {difference.max().item():.2e}, mean {difference.mean().item():.2e}, {moved} of {difference.numel()} rank positions changed"
 
     def evaluate_file(self, file, output_value=0):
         return self.evaluate_files([file], output_value=output_value)
+    
+    def stream_files(self, files, chunk_size=1024, output_value=0):
+        '''
+        Score an iterable of files chunk_size at a time, yielding (file, score) as each chunk is done, 
+        so memory use doesn't grow with the number of files
+        '''
+        def score_chunk(fs):
+            with torch.no_grad():
+                scores = self(torch.stack(list(self.feature_extractor.get_features_from_file(f, device=self.device) for f in fs)))
+            scores = scores[:,output_value] if output_value is not None else scores
+            return zip(fs, scores.cpu().tolist())
+        
+        chunk = []
+        for f in files:
+            chunk.append(f)
+            if len(chunk)==chunk_size:
+                yield from score_chunk(chunk)
+                chunk = []
+        if chunk: yield from score_chunk(chunk)
+
+    def top_k_files(self, files, k, largest=True, chunk_size=1024, output_value=0):
+        '''
+        The k highest (or lowest, if largest is False) scoring of an iterable of files, as a list of (score, file) 
+        best first, keeping only a heap of k entries in memory. Of files with equal scores, the earlier is kept and ranked 
+        first (as in SortByScores)
+        '''
+        if k<=0: return []
+        sign = 1 if largest else -1
+        heap = []
+        for n, (f, score) in enumerate(self.stream_files(files, chunk_size=chunk_size, output_value=output_value)):
+            item = (sign*score, -n, f)
+            if len(heap) < k: heapq.heappush(heap, item)
+            elif item > heap[0]: heapq.heapreplace(heap, item)
+        return list((sign*s, f) for s, _, f in sorted(heap, reverse=True))
             
 #import os
 #   def evaluate_directory(self, directory, as_sorted_tuple=False, eval_mode=False, output_value=0):
 #       return self.evaluate_files([os.path.join(directory,f) for f in os.listdir(directory)], as_sorted_tuple, eval_mode, output_value=output_value)
-    
\ No newline at end of file
+    
+class CompiledHead(nn.Module):
+    '''
+    Inference-only copy of an AestheticPredictor head, with the same forward. Dropout is dropped, and the preprocess weights
+    are folded into the first Linear (so x is just flattened) when there are no hidden layers - making the whole head one 
+    matmul - or when the first layer has a single output. Otherwise the preprocess is a weighted sum over the layers 
+    dimension, without the permute and reshape. Quantized (int8) heads are dequantized.
+    '''
+    def __init__(self, predictor:AestheticPredictor):
+        super().__init__()
+        linears = list(linear_weight_and_bias(m) for m in linear_layers(predictor.main_process))
+        dtype = predictor.dtype
+        preprocess = linear_weight_and_bias(predictor.preprocess)[0].squeeze(0) if predictor.preprocess else None
+        self.fold = preprocess is not None and (len(linears)==1 or linears[0][0].shape[0]==1)
+        if self.fold:
+            weight, bias = linears[0]
+            linears[0] = ((preprocess.view(1,-1,1) * weight.unsqueeze(1)).flatten(1), bias) # [out, layers*features]
+        self.input_shape = (predictor.weight_n_output_layers, predictor.number_of_features) if preprocess is not None else (predictor.number_of_features,)
+        self.number_of_layers = len(linears)
+        for l, (weight, bias) in enumerate(linears):
+            self.register_buffer(f"weight{l}", weight.to(dtype).contiguous())
+            self.register_buffer(f"bias{l}", bias.to(dtype) if bias is not None else None)
+        self.register_buffer("preprocess", preprocess.to(dtype) if preprocess is not None and not self.fold else None)
+
+    @property
+    def device(self): return self.weight0.device
+
+    def forward(self, x):
+        h = x.to(self.weight0.dtype)
+        if self.fold: h = h.flatten(1)
+        elif self.preprocess is not None: h = torch.einsum('bnd,n->bd', h, self.preprocess)
+        for l in range(self.number_of_layers):
+            h = F.linear(h, getattr(self, f"weight{l}"), getattr(self, f"bias{l}"))
+            if l < self.number_of_layers-1: h = torch.relu(h)
+        return h.float()
+
+    def example_input(self, batch_size=1) -> torch.Tensor:
+        return torch.zeros((batch_size,)+self.input_shape, dtype=self.weight0.dtype, device=self.device)
+
+    def to_torchscript(self) -> torch.jit.ScriptModule:
+        with torch.no_grad():
+            return torch.jit.freeze(torch.jit.trace(self.eval(), self.example_input()))
+
+    def export_onnx(self, filepath):
+        torch.onnx.export(self.eval(), (self.example_input(),), filepath, input_names=["features"], output_names=["scores"],
+                          dynamic_axes={"features":{0:"batch"}, "scores":{0:"batch"}})
+
+class StackedHeads(nn.Module):
+    '''
+    AestheticPredictor heads with the same layer shapes, with the weights of each layer stacked so that all heads 
+    are evaluated with one batched matmul per layer. forward returns [heads, batch, output_channels]
+    '''
+    def __init__(self, predictors:list):
+        super().__init__()
+        linears = list( list(linear_weight_and_bias(m) for m in linear_layers(p.main_process)) for p in predictors )
+        dtype = predictors[0].dtype
+        self.number_of_heads = len(predictors)
+        self.number_of_layers = len(linears[0])
+        for l in range(self.number_of_layers):
+            layer = list(ls[l] for ls in linears)
+            self.register_buffer(f"weight{l}", torch.stack(list(w.t() for w, _ in layer)).to(dtype))
+            self.register_buffer(f"bias{l}", torch.stack(list(b if b is not None else torch.zeros_like(w[:,0]) for w, b in layer)).unsqueeze(1).to(dtype))
+        self.register_buffer("preprocess", torch.stack(list(linear_weight_and_bias(p.preprocess)[0].squeeze(0) for p in predictors)).to(dtype) if predictors[0].preprocess else None)
+
+    @property
+    def device(self): return self.bias0.device
+
+    def forward(self, x):
+        x = x.to(self.bias0.dtype)
+        if self.preprocess is not None:
+            h = torch.einsum('bnd,hn->hbd', x, self.preprocess)
+        else:
+            h = x.unsqueeze(0).expand(self.number_of_heads, -1, -1)
+        for l in range(self.number_of_layers):
+            h = torch.baddbmm(getattr(self, f"bias{l}"), h, getattr(self, f"weight{l}"))
+            if l < self.number_of_layers-1: h = torch.relu(h)
+        return h.float()
+    
+class FusedAestheticPredictors(nn.Module):
+    '''
+    Evaluate several AestheticPredictors together. Heads are grouped by feature extractor and layer shapes; the features 
+    are calculated once per feature extractor, and each group is evaluated in one pass by a StackedHeads.
+    '''
+    def __init__(self, predictors:list):
+        super().__init__()
+        self.predictors = predictors
+        groups = {}
+        for i, p in enumerate(predictors): groups.setdefault((id(p.feature_extractor),) + self.structure(p), []).append(i)
+        self.groups = list(groups.values())
+        self.stacks = nn.ModuleList(StackedHeads(list(predictors[i] for i in group)) for group in self.groups)
+
+    @staticmethod
+    def structure(p:AestheticPredictor) -> tuple:
+        return (p.precision, p.weight_n_output_layers if p.preprocess else 0,) + tuple(tuple(linear_weight_and_bias(m)[0].shape) for m in linear_layers(p.main_process))
+
+    def evaluate_images(self, images:torch.Tensor, batch_size=8) -> list:
+        '''
+        Score a [B,H,W,C] IMAGE tensor with every head; returns a list of [B, output_channels] tensors in the order of the predictors
+        '''
+        batch_size = batch_size or len(images)
+        results = [None,] * len(self.predictors)
+        with torch.no_grad():
+            for group, stack in zip(self.groups, self.stacks):
+                features = self.predictors[group[0]].feature_extractor.get_image_features_batch(images, batch_size=batch_size)
+                with Stats.timer("head"):
+                    scores = torch.cat(list(stack(features[i:i+batch_size].to(stack.device)) for i in range(0, len(features), batch_size)), dim=1)
+                for j, k in enumerate(group): results[k] = scores[j]
+        return results
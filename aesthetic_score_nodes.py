@@ -1,11 +1,12 @@
 import folder_paths
-import json, os
-from .aesthetic_predictor import AestheticPredictor
-from PIL import Image
-import numpy as np
+import os
+from .aesthetic_predictor import AestheticPredictor, FusedAestheticPredictors
+from .feature_extractor import FeatureExtractor, FeatureExtractorException, PRECISIONS
 import torch
 from .ui_decorator import ui_signal
-from comfy.model_management import get_torch_device, free_memory, unet_offload_device, soft_empty_cache
+from .model_cache import ModelCache
+from .instrumentation import Stats, timed
+from comfy.model_management import get_torch_device, unet_offload_device
 
 class BaseClassifier:
     CATEGORY = "CustomAestheticScorer"
@@ -16,77 +17,169 @@ class BaseClassifier:
         self.model_path = None
         self.model_metadata = None
 
-    def load_model(self, custom_model, device):
-        path = os.path.join(folder_paths.folder_names_and_paths["customaesthetic"][0][0], custom_model)
-        free_memory(2*1024*1024*1024, get_torch_device())
-        if not (self.model_path and self.model_path==path): 
-            with open(path, "rb") as f:
-                data = f.read()
-                n_header = data[:8]
-            n = int.from_bytes(n_header, "little")
-            metadata_bytes = data[8 : 8 + n]
-            header = json.loads(metadata_bytes)
-            self.model_metadata = header.get("__metadata__", {})
-            self.model = AestheticPredictor.from_pretrained(path, use_cache=False, base_directory=os.path.dirname(os.path.realpath(__file__)))
-        self.model.to(device)
-        #self.model.to(torch.half)
-        self.model_path = path
+    def load_model(self, custom_model, device, precision="fp32"):
+        return self.load_models([custom_model], device, precision)[0]
+
+    def load_models(self, custom_models:list, device, precision="fp32") -> list:
+        '''
+        Load the heads custom_models and their backbones, then move them all to the GPU together - so that neither 
+        the RAM nor the VRAM budget can evict or offload one of them to make room for another
+        '''
+        with Stats.timer("load_model"):
+            if precision=="int8": device = "cpu"
+            offload_device = "cpu" if precision=="int8" else unet_offload_device()
+            models, keys = [], []
+            for custom_model in custom_models:
+                path = os.path.join(folder_paths.folder_names_and_paths["customaesthetic"][0][0], custom_model)
+                self.model_metadata, _ = AestheticPredictor.load_metadata_and_sd(path, return_sd=False)
+                metadata = self.model_metadata
+                backbone_key = FeatureExtractor.backbone_key(metadata, precision)
+                feature_extractor = ModelCache.get(backbone_key, lambda: FeatureExtractor.get_feature_extractor(pretrained=metadata["feature_extractor_model"], 
+                                                                                                                ap_metadata=metadata, use_cache=False, 
+                                                                                                                device=offload_device, precision=precision,
+                                                                                                                base_directory=os.path.dirname(os.path.realpath(__file__))),
+                                                   keep=tuple(keys))
+                keys.append(backbone_key)
+                model = ModelCache.get((path, precision), lambda: AestheticPredictor(feature_extractor=feature_extractor, pretrained=path, device=offload_device, precision=precision),
+                                       modules=lambda ap: ap.managed_modules(include_feature_extractor=False), 
+                                       resident=lambda ap: ap.resident_modules(include_feature_extractor=False), keep=tuple(keys))
+                keys.append((path, precision))
+                model.feature_extractor = feature_extractor   # in case the backbone was evicted and reloaded since the head was cached
+                models.append(model)
+                self.model_path = path
+            ModelCache.load_gpu(*dict.fromkeys(keys))
+            for model in models: model.to(device)
+            self.model = models[-1]
+            return models
+
+    def load_head(self, custom_model, device):
+        '''
+        Load just the head of custom_model (no feature extractor), for scoring features computed elsewhere
+        '''
+        with Stats.timer("load_model"):
+            path = os.path.join(folder_paths.folder_names_and_paths["customaesthetic"][0][0], custom_model)
+            self.model = ModelCache.get((path, "head"), lambda: AestheticPredictor.no_feature_extractor(path, device=unet_offload_device()))
+            ModelCache.load_gpu((path, "head"))
+            self.model.to(device)
+            self.model_path = path
+            self.model_metadata = self.model.metadata
+            return self.model
 
 @ui_signal(['display_text'])
+@timed
 class ImageScorer(BaseClassifier):
     @classmethod
     def INPUT_TYPES(cls):
         return {"required": {"custom_model": (folder_paths.get_filename_list("customaesthetic"), ),
                              "images": ("IMAGE", {}),
-        } }
+                             "batch_size": ("INT", {"default":8, "min":1, "max":256}),
+                             "precision": (list(PRECISIONS), {}),
+                             },
+                "optional": { "check_drift": ("BOOLEAN", {"default":False}), },
+                }
     
     RETURN_TYPES = ("STRING", "IMAGE", "FLOATLIST", )
     RETURN_NAMES = ("scores_str", "images", "scores", )
 
-    def func(self, custom_model, images):
-        self.load_model(custom_model, get_torch_device())
-        scores = []
-        for im in images:
-            i = 255. * im.cpu().numpy()
-            img = Image.fromarray(np.clip(i, 0, 255).astype(np.uint8))
-            with torch.no_grad():
-                scores.append(self.model.scale(self.model.evaluate_image(img)))
-        score_string = ",".join(str(x) for x in scores)
-        self.model.to(unet_offload_device())
-        soft_empty_cache()
-        return ( score_string, images, scores, score_string )
+    def func(self, custom_model, images, batch_size=8, precision="fp32", check_drift=False):
+        scores = self.load_model(custom_model, get_torch_device(), precision).evaluate_images(images, batch_size=batch_size)[:,0]
+        score_string = ",".join(str(x) for x in scores.tolist())
+        display_text = score_string
+        if check_drift and precision!="fp32":
+            reference = self.load_model(custom_model, get_torch_device()).evaluate_images(images, batch_size=batch_size)[:,0]
+            display_text += "\n" + AestheticPredictor.drift(scores, reference)
+        return ( score_string, images, scores.tolist(), display_text )
+    
+@ui_signal(['display_text'])
+@timed
+class MultiImageScorer(BaseClassifier):
+    MAX_HEADS = 6
+    
+    @classmethod
+    def INPUT_TYPES(cls):
+        models = folder_paths.get_filename_list("customaesthetic")
+        return {"required": {"custom_model_1": (models, ),
+                             "images": ("IMAGE", {}),
+                             "batch_size": ("INT", {"default":8, "min":1, "max":256}),
+                             "precision": (list(PRECISIONS), {}),
+                             },
+                "optional": { f"custom_model_{i}": (["none",] + models, ) for i in range(2, cls.MAX_HEADS+1) }, 
+                }
     
+    RETURN_TYPES = ("STRING", "IMAGE",) + ("FLOATLIST",)*MAX_HEADS
+    RETURN_NAMES = ("scores_str", "images",) + tuple(f"scores_{i}" for i in range(1, MAX_HEADS+1))
+
+    def __init__(self):
+        super().__init__()
+        self.fused = None
+
+    def func(self, images, batch_size=8, precision="fp32", **kwargs):
+        custom_models = list(kwargs.get(f"custom_model_{i}", "none") for i in range(1, self.MAX_HEADS+1))
+        loaded = iter(self.load_models(list(cm for cm in custom_models if cm!="none"), get_torch_device(), precision))
+        heads = list(next(loaded) if cm!="none" else None for cm in custom_models)
+        used = list(h for h in heads if h is not None)
+        if self.fused is None or self.fused[0]!=tuple(id(h) for h in used):
+            self.fused = (tuple(id(h) for h in used), FusedAestheticPredictors(used))
+        results = iter(self.fused[1].evaluate_images(images, batch_size=batch_size))
+        scores = list(next(results)[:,0].tolist() if h is not None else None for h in heads)
+        score_string = "\n".join(f"{custom_models[i]}: " + ",".join(str(x) for x in s) for i, s in enumerate(scores) if s is not None)
+        return ( score_string, images, *scores, score_string )
+
 @ui_signal(['display_text'])
+@timed
 class ConditioningScorer(BaseClassifier):
+    '''
+    Score the pooled_output of every entry of a CONDITIONING with a head trained on text features, in one head forward.
+    Only the head is loaded.
+    '''
     @classmethod
     def INPUT_TYPES(cls):
         return {"required": {"custom_model": (folder_paths.get_filename_list("customaesthetic"), ),
                              "conditioning": ("CONDITIONING", {}),
         } }
     
-    RETURN_TYPES = ("STRING", "CONDITIONING", "FLOAT", )
-    RETURN_NAMES = ("score_str", "conditioning", "score", )
+    RETURN_TYPES = ("STRING", "CONDITIONING", "FLOATLIST", )
+    RETURN_NAMES = ("score_str", "conditioning", "scores", )
 
     def func(self, custom_model, conditioning):
-        self.load_model(custom_model, get_torch_device())
-        score = self.model.scale(conditioning[0]['pooled_output'])
-
-        return ( f"{score}", conditioning, score, f"{score}", )
+        head = self.load_head(custom_model, get_torch_device())
+        if any(c[1].get("pooled_output", None) is None for c in conditioning):
+            raise FeatureExtractorException("Every conditioning entry needs a pooled_output to be scored")
+        pooled = torch.cat(list(c[1]["pooled_output"].reshape(-1, c[1]["pooled_output"].shape[-1]) for c in conditioning))
+        if head.weight_n_output_layers > 1 or pooled.shape[-1]!=head.number_of_features:
+            raise FeatureExtractorException(f"{custom_model} expects {head.number_of_features} features"
+                                            f"{f' from {head.weight_n_output_layers} layers' if head.weight_n_output_layers > 1 else ''}, "
+                                            f"pooled_output has {pooled.shape[-1]}")
+        with torch.no_grad(), Stats.timer("head"):
+            scores = head(pooled.to(head.device))[:,0].tolist()
+        score_string = ",".join(str(x) for x in scores)
+        return ( score_string, conditioning, scores, score_string, )
 
+@timed
 class SortByScores:
+    '''
+    Sort images by score with a stable argsort (equal scores keep their order) and one gather. Also outputs the k highest 
+    (best first) and k lowest (worst first) scoring images, those scoring at least threshold (in the sort order), the 
+    sorted scores and the permutation (sorted position -> input index). The subsets are gathered directly from the input.
+    An empty subset is an IMAGE batch of size 0.
+    '''
     CATEGORY = "CustomAestheticScorer"
     FUNCTION = "func"    
     
     @classmethod
     def INPUT_TYPES(cls):
-        return {"required": {"images": ("IMAGE", {}), "scores": ("FLOATLIST",), "order": (["descending", "ascending"], ) } }
+        return {"required": {"images": ("IMAGE", {}), "scores": ("FLOATLIST",), "order": (["descending", "ascending"], ) },
+                "optional": {"k": ("INT", {"default":1, "min":0, "max":10000}), "threshold": ("FLOAT", {"default":0.5, "step":0.001}) } }
     
-    RETURN_TYPES = ("IMAGE", )
-    RETURN_NAMES = ("images", )
+    RETURN_TYPES = ("IMAGE", "IMAGE", "IMAGE", "IMAGE", "FLOATLIST", "INTLIST", )
+    RETURN_NAMES = ("images", "top_k", "bottom_k", "above_threshold", "sorted_scores", "indices", )
 
-    def func(self, images:torch.Tensor, scores, order):
-        score_image = list( (score, images[i]) for i, score in enumerate(scores) )
-        score_image.sort(reverse=(order=='descending'))
-        sorted_images = list( si[1] for si in score_image )
-        result = torch.stack( sorted_images )
-        return (result, )
\ No newline at end of file
+    def func(self, images:torch.Tensor, scores, order, k=1, threshold=0.5):
+        scores = torch.as_tensor(scores, dtype=torch.float64)
+        assert len(scores)==len(images)
+        ascending = torch.argsort(scores, stable=True)
+        descending = torch.argsort(scores, descending=True, stable=True)
+        permutation = descending if order=='descending' else ascending
+        above = permutation[scores[permutation] >= threshold]
+        gather = lambda indices: images.index_select(0, indices.to(images.device))
+        return (gather(permutation), gather(descending[:k]), gather(ascending[:k]), gather(above), scores[permutation].tolist(), permutation.tolist(), )
\ No newline at end of file
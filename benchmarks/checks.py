@@ -0,0 +1,221 @@
+'''
+Behaviour checks for cases the benchmarks don't exercise, runnable in the same offline setting (stubbed ComfyUI, tiny
+random CLIP model):
+
+    python benchmarks/checks.py [--only name,...]
+
+Each check_ method raises AssertionError if it fails; the exit code is 1 if any did.
+'''
+import os, sys, time, argparse, tempfile, traceback, shutil
+import torch
+from PIL import Image
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from run_benchmarks import Suite
+
+class Checks(Suite):
+    def check_ram_budget_smaller_than_model(self):
+        # the backbone and head a node is loading must survive a budget too small for both
+        ModelCache = self.m("model_cache").ModelCache
+        ModelCache.clear()
+        budget, ModelCache.ram_budget = ModelCache.ram_budget, 1000
+        try:
+            node = self.m("aesthetic_score_nodes").ImageScorer()
+            for head in ("mlp.safetensors", "linear.safetensors", "mlp.safetensors"):
+                scores = node.func(custom_model=head, images=torch.rand((2, 64, 64, 3)), batch_size=2)[2]
+                assert len(scores)==2
+            assert len(ModelCache.entries)==2, list(ModelCache.entries)
+        finally:
+            ModelCache.ram_budget = budget
+            ModelCache.clear()
+
+    def check_feature_memo(self):
+        # memo hits and a disabled memo (nothing hashed or kept) give the features the backbone gives
+        FeatureMemo = self.m("feature_memo").FeatureMemo
+        fe = self.predictor("mlp", use_cache=False).feature_extractor
+        images = torch.rand((5, 96, 80, 3))
+        reference = fe._get_image_features_batch(images)
+        FeatureMemo.clear()
+        budget = FeatureMemo.budget
+        try:
+            for FeatureMemo.budget in (budget, budget, 0):
+                assert torch.allclose(fe.get_image_features_batch(images.clone(), batch_size=2), reference, atol=1e-6)
+            assert len(FeatureMemo.entries)==5
+            FeatureMemo.clear()
+            fe.get_image_features_batch(images.clone(), batch_size=2)
+            assert len(FeatureMemo.entries)==0
+        finally:
+            FeatureMemo.budget = budget
+            FeatureMemo.clear()
+
+    def check_cpu_engine_batches_files(self):
+        # with and without the feature cache, files reach the backbone batch_size at a time, and score the same
+        CPUEngine = self.m("cpu_engine").CPUEngine
+        files = self.files[:12]
+        scores = []
+        for use_cache in (False, True):
+            predictor = self.predictor("mlp", image_directory=os.path.join(self.directory, f"engine_cache_{use_cache}"), use_cache=use_cache)
+            engine = CPUEngine(predictor, threads=torch.get_num_threads(), mode="eager", batch_size=8)
+            fe, sizes = engine.feature_extractor, []
+            forward = fe._features_from_prepared
+            fe._features_from_prepared = lambda prepared: sizes.append(len(prepared)) or forward(prepared)
+            scores.append(engine.evaluate_files(files))
+            assert sizes==[8, 4], (use_cache, sizes)
+        assert torch.allclose(scores[0], scores[1], atol=1e-5)
+
+    def check_save_if(self):
+        # every passing image saved, under distinct names, as complete PNGs with no temporary files left
+        node = self.m("utility_nodes").SaveIf()
+        images = torch.rand((4, 32, 40, 3))
+        names = []
+        save_images, delegated = node.save_images, []
+        node.save_images = lambda images, **kwargs: delegated.append(len(images)) or save_images(images, **kwargs)
+        for background_save in (True, False):
+            result = node.func([0.9, 0.1, 0.7, 0.5], 0.5, images, mode="all", background_save=background_save, filename_prefix="checks/saveif")
+            names += list(os.path.join(node.output_dir, r["subfolder"], r["filename"]) for r in result["ui"]["images"])
+        deadline = time.time() + 10
+        while not all(os.path.exists(n) for n in names) and time.time() < deadline: time.sleep(0.01)
+        assert len(set(names))==6 and delegated==[3], (names, delegated)
+        for name in names:
+            with Image.open(name) as image: assert image.size==(40, 32)
+        assert not any(f.endswith(".tmp") for f in os.listdir(os.path.dirname(names[0])))
+
+    def check_message_bus_survives_send_errors(self):
+        # a message that fails to send doesn't stop later ones
+        MessageBus = self.m("message_bus").MessageBus
+        from server import PromptServer
+        sent, send_sync = [], PromptServer.instance.send_sync
+        def failing_send(event, payload, sid=None):
+            if payload["id"]=="bad": raise TypeError("not serializable")
+            sent.append(payload)
+        PromptServer.instance.send_sync = failing_send
+        try:
+            MessageBus.post("bad", "first")
+            time.sleep(3*MessageBus.interval)
+            MessageBus.post("good", "second")
+            deadline = time.time() + 10
+            while not sent and time.time() < deadline: time.sleep(0.01)
+            assert sent and sent[0]["message"]=="second", sent
+        finally:
+            PromptServer.instance.send_sync = send_sync
+
+    def check_stats_per_node_id(self):
+        # two nodes of the same class are reported separately, under their UNIQUE_ID, with the class alongside
+        Stats = self.m("instrumentation").Stats
+        ScoreOperations = self.m("utility_nodes").ScoreOperations
+        assert ScoreOperations.INPUT_TYPES()["hidden"]["node_id"]=="UNIQUE_ID"
+        Stats.reset()
+        for node_id in ("5", "7", "7"):
+            ScoreOperations().func(x=[1.0, 2.0], y=[3.0, 4.0], z=0.0, operation="x+y", node_id=node_id)
+        nodes = Stats.snapshot()["nodes"]
+        assert nodes["5"]["class"]=="ScoreOperations" and nodes["5"]["timers"]["total"]["calls"]==1, nodes
+        assert nodes["7"]["timers"]["total"]["calls"]==2, nodes
+        Stats.reset()
+
+    def check_from_pretrained_precision(self):
+        # precision applies to the head as well as the backbone
+        predictor = self.predictor("mlp", precision="int8", use_cache=False)
+        assert predictor.precision=="int8" and predictor.feature_extractor.precision=="int8"
+        assert len(predictor.evaluate_images(torch.rand((2, 64, 64, 3)), batch_size=2))==2
+
+    def check_ram_budget_counts_int8_models(self):
+        # int8 models aren't managed by comfy, but still count against the RAM budget and are evicted
+        ModelCache = self.m("model_cache").ModelCache
+        ModelCache.clear()
+        node = self.m("aesthetic_score_nodes").ImageScorer()
+        budget = ModelCache.ram_budget
+        try:
+            node.func(custom_model="mlp.safetensors", images=torch.rand((2, 64, 64, 3)), batch_size=2, precision="int8")
+            sizes = list(e[2] for e in ModelCache.entries.values())
+            assert len(sizes)==2 and all(size > 0 for size in sizes), sizes
+            ModelCache.ram_budget = sum(sizes)
+            node.func(custom_model="linear.safetensors", images=torch.rand((2, 64, 64, 3)), batch_size=2, precision="int8")
+            assert sum(e[2] for e in ModelCache.entries.values()) <= ModelCache.ram_budget, list(ModelCache.entries)
+        finally:
+            ModelCache.ram_budget = budget
+            ModelCache.clear()
+
+    def check_multi_image_scorer_keeps_all_heads(self):
+        # loading a later head (with its own backbone) doesn't evict or offload the earlier ones in the same execution
+        ModelCache = self.m("model_cache").ModelCache
+        ModelCache.clear()
+        budget, ModelCache.ram_budget = ModelCache.ram_budget, 1000
+        loaded = []
+        load_gpu = ModelCache.load_gpu.__func__
+        ModelCache.load_gpu = classmethod(lambda cls, *keys: loaded.append(keys) or load_gpu(cls, *keys))
+        try:
+            node = self.m("aesthetic_score_nodes").MultiImageScorer()
+            result = node.func(images=torch.rand((2, 64, 64, 3)), batch_size=2, custom_model_1="mlp.safetensors", custom_model_2="weighted.safetensors")
+            assert len(result[2])==2 and len(result[3])==2
+            assert len(ModelCache.entries)==4, list(ModelCache.entries)
+            assert len(loaded)==1 and set(loaded[0])==set(ModelCache.entries), loaded
+        finally:
+            ModelCache.load_gpu = classmethod(load_gpu)
+            ModelCache.ram_budget = budget
+            ModelCache.clear()
+
+    def check_top_k_files(self):
+        # k=0 is empty, and ties (each image is in two files) keep and rank first the earlier file, as a stable sort does
+        predictor = self.predictor("mlp", use_cache=False)
+        copies = list(os.path.join(self.directory, f"copy_{os.path.basename(f)}") for f in self.files[:4])
+        for f, copy in zip(self.files[:4], copies): shutil.copyfile(f, copy)
+        files = self.files[:4] + copies
+        scores = list(score for _, score in predictor.stream_files(files))
+        assert predictor.top_k_files(files, 0)==[]
+        for largest in (True, False):
+            expected = sorted(range(len(files)), key=lambda n: -scores[n] if largest else scores[n])[:5]
+            top = predictor.top_k_files(files, 5, largest=largest, chunk_size=3)
+            assert [f for _, f in top]==[files[n] for n in expected], (largest, top, expected)
+
+    def check_cpu_head_independent_of_file(self):
+        # a head kept on the CPU doesn't change when its .safetensors file is rewritten in place
+        AestheticPredictor = self.m("aesthetic_predictor").AestheticPredictor
+        for head in ("mlp", "weighted"):
+            path = os.path.join(self.directory, f"rewritten_{head}.safetensors")
+            shutil.copyfile(self.heads[head], path)
+            predictor = AestheticPredictor.no_feature_extractor(path, device="cpu")
+            x = torch.randn((3,) + predictor.compiled_head().input_shape)
+            reference = predictor(x)
+            n, _ = AestheticPredictor.read_header(path)
+            with open(path, "r+b") as f:
+                f.seek(8 + n)
+                f.write(bytes(os.path.getsize(path) - 8 - n))
+            assert torch.equal(predictor(x), reference), head
+
+    def check_feature_store_errors(self):
+        # precision and shape mismatches raise FeatureExtractorException, naming the store
+        FeatureStore = self.m("feature_store").FeatureStore
+        FeatureExtractorException = self.m("feature_extractor").FeatureExtractorException
+        directory = os.path.join(self.directory, "store")
+        store = FeatureStore(directory, precision="fp32")
+        store["a"] = torch.zeros(4)
+        store.flush()
+        for attempt in (lambda: store.__setitem__("b", torch.zeros(5)), lambda: FeatureStore(directory, precision="fp16")):
+            try:
+                attempt()
+                raise AssertionError("no exception")
+            except FeatureExtractorException as e:
+                assert directory in str(e), e
+
+    def run_checks(self, only=None) -> bool:
+        ok = True
+        for name in sorted(n for n in dir(self) if n.startswith("check_")):
+            if only and name[6:] not in only: continue
+            try:
+                getattr(self, name)()
+                print(f"{name[6:]:<50} ok")
+            except Exception:
+                ok = False
+                print(f"{name[6:]:<50} FAILED")
+                traceback.print_exc()
+        return ok
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--only", default=None, help="comma separated subset of the checks (without check_)")
+    args = parser.parse_args()
+    with tempfile.TemporaryDirectory() as directory:
+        ok = Checks(directory, repeats=1, files=16).run_checks(args.only.split(",") if args.only else None)
+    if not ok: sys.exit(1)
+
+if __name__ == "__main__":
+    main()
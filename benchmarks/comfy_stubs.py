@@ -0,0 +1,93 @@
+'''
+Minimal stand-ins for the ComfyUI modules the node pack imports (folder_paths, server, nodes, comfy.model_management,
+comfy.model_patcher, comfy.cli_args), so the benchmarks can run outside ComfyUI. install() does nothing if ComfyUI itself can be imported.
+'''
+import sys, os, types, tempfile, importlib.util
+import torch
+
+PACK_DIRECTORY = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def install(directory=None):
+    try:
+        import folder_paths, server, nodes, comfy.model_management
+        return
+    except ImportError:
+        pass
+    directory = directory or tempfile.mkdtemp()
+
+    folder_paths = types.ModuleType("folder_paths")
+    folder_paths.models_dir = os.path.join(directory, "models")
+    folder_paths.folder_names_and_paths = {}
+    folder_paths.get_filename_list = lambda key: []
+    folder_paths.get_output_directory = lambda: os.path.join(directory, "output")
+    folder_paths.get_user_directory = lambda: os.path.join(directory, "user")
+    def get_save_image_path(filename_prefix, output_dir, image_width=0, image_height=0):
+        subfolder, filename = os.path.split(os.path.normpath(filename_prefix))
+        full_output_folder = os.path.join(output_dir, subfolder)
+        os.makedirs(full_output_folder, exist_ok=True)
+        counters = list(int(f[len(filename)+1:].split("_")[0]) for f in os.listdir(full_output_folder) 
+                        if f.startswith(filename + "_") and f[len(filename)+1:].split("_")[0].isdigit())
+        return full_output_folder, filename, max(counters, default=0) + 1, subfolder, filename_prefix
+    folder_paths.get_save_image_path = get_save_image_path
+
+    class Routes:
+        def get(self, path): return lambda f: f
+        def post(self, path): return lambda f: f
+    class PromptServer:
+        instance = None
+        def __init__(self): self.routes = Routes()
+        def send_sync(self, event, data, sid=None): pass
+    PromptServer.instance = PromptServer()
+    server = types.ModuleType("server")
+    server.PromptServer = PromptServer
+
+    class SaveImage:
+        def __init__(self):
+            self.output_dir = folder_paths.get_output_directory()
+            self.type = "output"
+            self.prefix_append = ""
+            self.compress_level = 4
+        @classmethod
+        def INPUT_TYPES(s): return {"required": {"images": ("IMAGE",), "filename_prefix": ("STRING", {"default": "ComfyUI"})}, "hidden": {}}
+        def save_images(self, images, filename_prefix="ComfyUI", prompt=None, extra_pnginfo=None):
+            from PIL import Image
+            full_output_folder, filename, counter, subfolder, filename_prefix = folder_paths.get_save_image_path(
+                filename_prefix + self.prefix_append, self.output_dir, images[0].shape[1], images[0].shape[0])
+            results = []
+            for batch_number, image in enumerate(images):
+                file = f"{filename.replace('%batch_num%', str(batch_number))}_{counter:05}_.png"
+                Image.fromarray((255. * image.cpu().numpy()).clip(0, 255).astype("uint8")).save(os.path.join(full_output_folder, file), compress_level=self.compress_level)
+                results.append({"filename": file, "subfolder": subfolder, "type": self.type})
+                counter += 1
+            return { "ui": { "images": results } }
+    nodes = types.ModuleType("nodes")
+    nodes.SaveImage = SaveImage
+
+    cli_args = types.ModuleType("comfy.cli_args")
+    cli_args.args = types.SimpleNamespace(disable_metadata=False)
+    model_management = types.ModuleType("comfy.model_management")
+    model_management.get_torch_device = lambda: torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    model_management.unet_offload_device = lambda: torch.device("cpu")
+    model_management.current_loaded_models = []
+    model_management.load_models_gpu = lambda models, **kwargs: None
+    model_management.module_size = lambda m: sum(p.numel() * p.element_size() for p in m.parameters())
+    model_patcher = types.ModuleType("comfy.model_patcher")
+    class ModelPatcher:
+        def __init__(self, model, load_device, offload_device, size=0, **kwargs):
+            self.model, self.load_device, self.offload_device, self.size = model, load_device, offload_device, size
+    model_patcher.ModelPatcher = ModelPatcher
+    comfy = types.ModuleType("comfy")
+    comfy.model_management, comfy.model_patcher, comfy.cli_args = model_management, model_patcher, cli_args
+
+    sys.modules.update({ "folder_paths":folder_paths, "server":server, "nodes":nodes, "comfy":comfy,
+                         "comfy.model_management":model_management, "comfy.model_patcher":model_patcher, "comfy.cli_args":cli_args })
+
+def import_pack(name="node_pack"):
+    '''
+    Import the node pack (whatever its directory is called) as the package name
+    '''
+    spec = importlib.util.spec_from_file_location(name, os.path.join(PACK_DIRECTORY, "__init__.py"), submodule_search_locations=[PACK_DIRECTORY])
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    spec.loader.exec_module(module)
+    return module
@@ -0,0 +1,75 @@
+'''
+CPUEngine throughput (CPUEngine.benchmark: preprocessing, backbone and head) for the real CLIP vision architectures,
+runnable offline: the backbone is built with the architecture of the named model but random weights, which doesn't
+change the amount of work.
+
+    python benchmarks/engine_throughput.py [--architecture ViT-H/14] [--precisions fp32,int8] [--modes trace,eager]
+                                           [--threads N] [--images 16] [--target 0.5]
+
+Prints images/sec for each precision and mode; with --target, the exit code is 1 if the best is below it.
+'''
+import os, sys, json, argparse, tempfile, platform
+os.environ.setdefault("HF_HUB_OFFLINE", "1")
+os.environ.setdefault("TRANSFORMERS_OFFLINE", "1")
+import torch
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import comfy_stubs
+from run_benchmarks import build_head
+
+ARCHITECTURES = { # hidden size, layers, heads, patch size, projection
+    "ViT-B/32":(768, 12, 12, 32, 512),
+    "ViT-L/14":(1024, 24, 16, 14, 768),
+    "ViT-H/14":(1280, 32, 16, 14, 1024),
+}
+
+def build_clip(directory, architecture):
+    from transformers import CLIPConfig, CLIPModel, CLIPImageProcessor
+    hidden_size, layers, heads, patch_size, projection_dim = ARCHITECTURES[architecture]
+    config = CLIPConfig(text_config=dict(hidden_size=32, intermediate_size=64, num_hidden_layers=1, num_attention_heads=2, vocab_size=1000),
+                        vision_config=dict(hidden_size=hidden_size, intermediate_size=4*hidden_size, num_hidden_layers=layers,
+                                           num_attention_heads=heads, image_size=224, patch_size=patch_size),
+                        projection_dim=projection_dim)
+    CLIPModel(config).save_pretrained(directory)
+    CLIPImageProcessor(size={"shortest_edge":224}, crop_size={"height":224, "width":224}).save_pretrained(directory)
+    return directory, projection_dim
+
+def cpu_name() -> str:
+    try:
+        with open("/proc/cpuinfo") as f:
+            return next(line.split(":", 1)[1].strip() for line in f if line.startswith("model name"))
+    except (OSError, StopIteration):
+        return platform.processor()
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--architecture", default="ViT-H/14", choices=list(ARCHITECTURES))
+    parser.add_argument("--precisions", default="fp32,int8")
+    parser.add_argument("--modes", default="trace,eager")
+    parser.add_argument("--threads", type=int, default=None, help="default CG_CLASSIFIER_CPU_THREADS, or every core")
+    parser.add_argument("--images", type=int, default=16)
+    parser.add_argument("--batch-size", type=int, default=8)
+    parser.add_argument("--target", type=float, default=None, help="images/sec the best result must reach")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        comfy_stubs.install(directory)
+        pack = comfy_stubs.import_pack("node_pack")
+        from node_pack.aesthetic_predictor import AestheticPredictor
+        from node_pack.cpu_engine import CPUEngine
+        clip, features = build_clip(os.path.join(directory, "clip"), args.architecture)
+        head = build_head(os.path.join(directory, "heads", "head.safetensors"), clip, features, [256])
+        results = []
+        for precision in args.precisions.split(","):
+            for mode in args.modes.split(","):
+                engine = CPUEngine(AestheticPredictor.from_pretrained(head, device="cpu", precision=precision, use_cache=False),
+                                   threads=args.threads, mode=mode, batch_size=args.batch_size)
+                rate = engine.benchmark(number_of_images=args.images, size=512, warmup=1)
+                results.append({"precision":precision, "mode":mode, "images_per_second":rate})
+                print(f"{args.architecture:<10} {precision:<5} {mode:<8} {rate:>8.3f} images/sec")
+                del engine
+    print(json.dumps({ "cpu":cpu_name(), "cpu_count":os.cpu_count(), "threads":torch.get_num_threads(), "torch":torch.__version__,
+                       "architecture":args.architecture, "results":results }))
+    if args.target is not None and max(r["images_per_second"] for r in results) < args.target: sys.exit(1)
+
+if __name__ == "__main__":
+    main()
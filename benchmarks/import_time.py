@@ -0,0 +1,50 @@
+'''
+How long importing the node pack adds to ComfyUI startup.
+
+    python benchmarks/import_time.py [--repeats 5] [--json]
+
+Each repeat is a fresh interpreter which first imports what ComfyUI has loaded before it imports custom nodes (torch,
+numpy, PIL, aiohttp, and ComfyUI itself or the stand-ins in comfy_stubs), then times the import of the pack. Also lists which
+heavy modules the import pulled in - there should be none.
+'''
+import subprocess, sys, os, json, argparse, statistics
+
+HEAVY = ["transformers", "tqdm", "safetensors", "aim", "huggingface_hub", "tokenizers"]
+
+CHILD = '''
+import sys, time, json
+sys.path.insert(0, {benchmarks!r})
+import torch, numpy, PIL.Image
+try:
+    import aiohttp.web # imported by ComfyUI's server
+except ImportError:
+    pass
+import comfy_stubs
+comfy_stubs.install()
+before = set(sys.modules)
+start = time.perf_counter()
+comfy_stubs.import_pack()
+seconds = time.perf_counter() - start
+print(json.dumps({{ "seconds":seconds, "modules":len(set(sys.modules)-before), "heavy":list(m for m in {heavy!r} if m in sys.modules and m not in before) }}))
+'''
+
+def measure() -> dict:
+    code = CHILD.format(benchmarks=os.path.dirname(os.path.abspath(__file__)), heavy=HEAVY)
+    output = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True, check=True).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--repeats", type=int, default=5)
+    parser.add_argument("--json", action="store_true", help="print the results as json")
+    args = parser.parse_args()
+    runs = list(measure() for _ in range(args.repeats))
+    result = { "median_seconds":statistics.median(r["seconds"] for r in runs), "min_seconds":min(r["seconds"] for r in runs),
+               "modules_imported":runs[-1]["modules"], "heavy_modules_imported":runs[-1]["heavy"] }
+    if args.json: print(json.dumps(result, indent=2))
+    else: 
+        print(f"node pack import: median {result['median_seconds']*1000:.1f} ms, min {result['min_seconds']*1000:.1f} ms over {args.repeats} runs")
+        print(f"{result['modules_imported']} modules imported; heavy modules: {', '.join(result['heavy_modules_imported']) or 'none'}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,198 @@
+'''
+Benchmarks of the node pack's hot paths, runnable on a CPU-only machine with no network and no ComfyUI: the ComfyUI
+modules are replaced by comfy_stubs, and the backbone is a tiny randomly initialised CLIPModel built locally.
+
+    python benchmarks/run_benchmarks.py [--batch-sizes 1,8,32] [--repeats 5] [--output results.json] [--baseline old.json]
+
+Each benchmark is timed at each batch size (for ScoreOperations the batch is the length of the lists; for precache and
+evaluate_files it is the number of files per batch / files scored). Results are printed and, with --output, written as json.
+With --baseline, each result is compared with the same benchmark in an earlier results file, and the exit code is 1 if
+any is more than --tolerance times slower.
+'''
+import os, sys, json, time, argparse, tempfile, statistics, platform, importlib, shutil
+os.environ.setdefault("HF_HUB_OFFLINE", "1")
+os.environ.setdefault("TRANSFORMERS_OFFLINE", "1")
+import numpy as np
+import torch
+from PIL import Image
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import comfy_stubs
+
+def build_tiny_clip(directory, image_size=32, patch_size=8, hidden_size=32, layers=4, projection_dim=16):
+    from transformers import CLIPConfig, CLIPModel, CLIPImageProcessor
+    torch.manual_seed(0)
+    config = CLIPConfig(text_config=dict(hidden_size=hidden_size, intermediate_size=2*hidden_size, num_hidden_layers=2, num_attention_heads=2,
+                                         vocab_size=1000, max_position_embeddings=77),
+                        vision_config=dict(hidden_size=hidden_size, intermediate_size=2*hidden_size, num_hidden_layers=layers, num_attention_heads=2,
+                                           image_size=image_size, patch_size=patch_size),
+                        projection_dim=projection_dim)
+    CLIPModel(config).save_pretrained(directory)
+    CLIPImageProcessor(size={"shortest_edge":image_size}, crop_size={"height":image_size, "width":image_size}).save_pretrained(directory)
+    return directory
+
+def build_head(filepath, feature_extractor_model, number_of_features, layers:list, weight_n_output_layers=0, seed=0):
+    from safetensors.torch import save_file
+    torch.manual_seed(seed)
+    metadata = { "feature_extractor_model":feature_extractor_model, "layers":str(layers).replace(" ",""), "number_of_features":str(number_of_features) }
+    sd, size, i = {}, number_of_features, 1
+    for layer in layers + [1]:
+        sd[f"main_process.{i}.weight"] = torch.randn(layer, size) * 0.1
+        sd[f"main_process.{i}.bias"] = torch.randn(layer) * 0.1
+        size, i = layer, i + 3
+    if weight_n_output_layers > 1:
+        metadata["weight_n_output_layers"] = str(weight_n_output_layers)
+        sd["preprocess.weight"] = torch.rand(1, weight_n_output_layers)
+    os.makedirs(os.path.dirname(filepath), exist_ok=True)
+    save_file(sd, filepath, metadata=metadata)
+    return filepath
+
+def measure(function:callable, setup:callable=None, repeats=5) -> list:
+    '''
+    Seconds per call of function, repeats times. If there's no setup, cheap functions are called enough times per repeat
+    to take about 20ms
+    '''
+    if setup is None:
+        start = time.perf_counter()
+        function()
+        number = max(1, int(0.02 / max(time.perf_counter() - start, 1e-7)))
+    else:
+        number = 1
+    times = []
+    for _ in range(repeats):
+        if setup: setup()
+        start = time.perf_counter()
+        for _ in range(number): function()
+        times.append((time.perf_counter() - start) / number)
+    return times
+
+class Suite:
+    def __init__(self, directory, repeats, files):
+        self.directory = directory
+        self.repeats = repeats
+        self.results = []
+        comfy_stubs.install(directory)
+        comfy_stubs.import_pack("node_pack")
+        self.m = lambda name: importlib.import_module(f"node_pack.{name}")
+        import folder_paths
+        heads = os.path.join(directory, "customaesthetic")
+        folder_paths.folder_names_and_paths["customaesthetic"] = ([heads], [".safetensors"])
+
+        self.clip = build_tiny_clip(os.path.join(directory, "tiny_clip"))
+        self.heads = { "linear":build_head(os.path.join(heads, "linear.safetensors"), self.clip, 16, []),
+                       "mlp":build_head(os.path.join(heads, "mlp.safetensors"), self.clip, 16, [32, 8], seed=1),
+                       "weighted":build_head(os.path.join(heads, "weighted.safetensors"), self.clip, 16, [32], weight_n_output_layers=3, seed=2) }
+        self.image_directory = os.path.join(directory, "images")
+        os.makedirs(self.image_directory)
+        rng = np.random.default_rng(0)
+        self.files = []
+        for i in range(files):
+            self.files.append(os.path.join(self.image_directory, f"{i:05}.png"))
+            Image.fromarray(rng.integers(0, 256, (48, 64, 3), dtype=np.uint8)).save(self.files[-1])
+
+    def record(self, name, batch_size, items, times):
+        median = statistics.median(times)
+        self.results.append({ "name":name, "batch_size":batch_size, "median_ms":1000*median, "min_ms":1000*min(times),
+                              "items_per_second":items/median if median else None })
+        print(f"{name:<40} {batch_size:>5} {1000*median:>10.3f} ms {items/median if median else 0:>12.1f} /s")
+
+    def predictor(self, head, **kwargs):
+        AestheticPredictor = self.m("aesthetic_predictor").AestheticPredictor
+        return AestheticPredictor.from_pretrained(self.heads[head], device="cpu", **kwargs).eval()
+
+    def image_scorer(self, batch_size):
+        ImageScorer, FeatureMemo = self.m("aesthetic_score_nodes").ImageScorer, self.m("feature_memo").FeatureMemo
+        node = ImageScorer()
+        holder = {}
+        def setup():
+            # new images, so neither the FeatureMemo nor the last batch kept by the feature extractor help
+            FeatureMemo.clear()
+            holder['images'] = torch.rand((batch_size, 64, 64, 3))
+        run = lambda: node.func(custom_model="mlp.safetensors", images=holder['images'], batch_size=batch_size)
+        setup()
+        run()
+        self.record("ImageScorer.func", batch_size, batch_size, measure(run, setup=setup, repeats=self.repeats))
+
+    def precache(self, batch_size):
+        holder = {}
+        def setup():
+            shutil.rmtree(os.path.join(self.image_directory, "featurecache"), ignore_errors=True)
+            holder['fe'] = self.predictor("mlp", image_directory=os.path.join(self.image_directory, "featurecache"), use_cache=True).feature_extractor
+        run = lambda: holder['fe'].precache(self.files, delete_model=False, batch_size=batch_size)
+        self.record("FeatureExtractor.precache", batch_size, len(self.files), measure(run, setup=setup, repeats=self.repeats))
+
+    def forward(self, batch_size):
+        for head in self.heads:
+            predictor = self.predictor(head, use_cache=False)
+            compiled = predictor.compiled_head()
+            features = torch.randn((batch_size,) + compiled.input_shape)
+            with torch.no_grad():
+                self.record(f"AestheticPredictor.forward[{head}]", batch_size, batch_size, measure(lambda: predictor(features), repeats=self.repeats))
+                self.record(f"CompiledHead.forward[{head}]", batch_size, batch_size, measure(lambda: compiled(features), repeats=self.repeats))
+
+    def evaluate_files(self, batch_size):
+        predictor = self.predictor("mlp", image_directory=self.image_directory, use_cache=True)
+        files = self.files[:batch_size]
+        predictor.feature_extractor.precache(files, delete_model=False)
+        with torch.no_grad():
+            self.record("AestheticPredictor.evaluate_files", batch_size, len(files), measure(lambda: predictor.evaluate_files(files), repeats=self.repeats))
+
+    def sort_by_scores(self, batch_size):
+        node = self.m("aesthetic_score_nodes").SortByScores()
+        images = torch.rand((batch_size, 64, 64, 3))
+        scores = torch.rand(batch_size).tolist()
+        self.record("SortByScores.func", batch_size, batch_size,
+                    measure(lambda: node.func(images, scores, "descending", k=max(1, batch_size//4), threshold=0.5), repeats=self.repeats))
+
+    def score_operations(self, batch_size):
+        node = self.m("utility_nodes").ScoreOperations()
+        x, y = torch.rand(batch_size).tolist(), torch.rand(batch_size).tolist()
+        self.record("ScoreOperations.func[x if y>z]", batch_size, batch_size, measure(lambda: node.func(x, y, 0.5, "x if y>z"), repeats=self.repeats))
+        self.record("ScoreOperations.func[expression]", batch_size, batch_size,
+                    measure(lambda: node.func(x, y, 0.5, "expression", "0.7*x + 0.3*max(y, z)"), repeats=self.repeats))
+
+    BENCHMARKS = ("image_scorer", "precache", "forward", "evaluate_files", "sort_by_scores", "score_operations")
+
+    def run(self, batch_sizes, only=None):
+        for benchmark in self.BENCHMARKS:
+            if only and benchmark not in only: continue
+            for batch_size in batch_sizes: getattr(self, benchmark)(batch_size)
+        return self.results
+
+def compare(results, baseline, tolerance) -> bool:
+    old = { (r["name"], r["batch_size"]):r["median_ms"] for r in baseline["results"] }
+    ok = True
+    for r in results:
+        if (key := (r["name"], r["batch_size"])) not in old: continue
+        ratio = r["median_ms"] / old[key]
+        flag = "REGRESSION" if ratio > tolerance else ""
+        ok = ok and not flag
+        print(f"{r['name']:<40} {r['batch_size']:>5} {ratio:>7.2f}x {flag}")
+    return ok
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--batch-sizes", default="1,8,32")
+    parser.add_argument("--repeats", type=int, default=5)
+    parser.add_argument("--files", type=int, default=64, help="number of image files for precache")
+    parser.add_argument("--threads", type=int, default=None, help="torch threads (default: torch's choice)")
+    parser.add_argument("--only", default=None, help=f"comma separated subset of {','.join(Suite.BENCHMARKS)}")
+    parser.add_argument("--output", default=None, help="write the results to this json file")
+    parser.add_argument("--baseline", default=None, help="compare with this earlier results file")
+    parser.add_argument("--tolerance", type=float, default=1.25)
+    args = parser.parse_args()
+    if args.threads: torch.set_num_threads(args.threads)
+    batch_sizes = list(int(b) for b in args.batch_sizes.split(","))
+
+    with tempfile.TemporaryDirectory() as directory:
+        results = Suite(directory, args.repeats, max(args.files, max(batch_sizes))).run(batch_sizes, args.only.split(",") if args.only else None)
+    report = { "environment":{ "python":platform.python_version(), "torch":torch.__version__, "machine":platform.machine(),
+                               "cpu_count":os.cpu_count(), "torch_threads":torch.get_num_threads(), "cuda":torch.cuda.is_available() },
+               "results":results }
+    if args.output:
+        with open(args.output, 'w') as f: json.dump(report, f, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            if not compare(results, json.load(f), args.tolerance): sys.exit(1)
+
+if __name__ == "__main__":
+    main()
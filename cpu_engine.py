@@ -0,0 +1,99 @@
+import os, time, warnings
+import torch
+import torch.nn as nn
+from .aesthetic_predictor import AestheticPredictor
+
+class _Traceable(nn.Module):
+    '''
+    Lets torch.jit trace a method of a feature extractor: module (whose parameters the method uses) is registered
+    as a submodule, so its weights are traced as parameters rather than baked in as constants
+    '''
+    def __init__(self, module:nn.Module, method:callable):
+        super().__init__()
+        self.module = module
+        self.method = method
+
+    def forward(self, x): return self.method(x)
+
+class CPUEngine:
+    '''
+    Runs an AestheticPredictor (backbone and head) on the CPU, for bulk scoring on machines without a GPU.
+
+    The torch thread count is set to threads (default CG_CLASSIFIER_CPU_THREADS, or every core), the backbone is converted
+    to channels_last, and the backbone and head (as a CompiledHead) are replaced by frozen TorchScript traces (mode "trace"), 
+    by torch.compile (mode "compile", which needs a C++ compiler) or left as they are (mode "eager"). Images and files are
+    scored batch_size at a time.
+    '''
+    MODES = ("trace", "compile", "eager")
+
+    @staticmethod
+    def set_threads(threads:int=None) -> int:
+        threads = threads or int(os.environ.get("CG_CLASSIFIER_CPU_THREADS", 0)) or os.cpu_count()
+        torch.set_num_threads(threads)
+        return threads
+
+    def __init__(self, predictor:AestheticPredictor, threads:int=None, mode="trace", batch_size:int=16):
+        if mode not in self.MODES: raise Exception(f"Unknown mode {mode} - use one of {self.MODES}")
+        self.threads = self.set_threads(threads)
+        self.mode = mode
+        self.batch_size = batch_size
+        self.predictor = predictor.to("cpu").eval()
+        self.feature_extractor = fe = predictor.feature_extractor
+        if fe.model is not None: fe.model.to("cpu").eval()
+
+        with torch.no_grad():
+            if hasattr(fe, "_backbone_forward"):
+                if fe.model is None: fe._load()
+                fe.model.to(memory_format=torch.channels_last)
+                example = torch.zeros((1,3)+fe.tensor_processor.crop_size, dtype=fe.dtype).contiguous(memory_format=torch.channels_last)
+                backbone = self._compile(_Traceable(fe.model, fe._backbone_forward), example)
+                fe.accelerated = lambda pixel_values: backbone(pixel_values.contiguous(memory_format=torch.channels_last))
+            features = fe._get_image_features_batch(torch.zeros((1,224,224,3)))
+            self.head = self._compile(predictor.compiled_head(), features)
+
+    def _compile(self, module:nn.Module, example:torch.Tensor):
+        if self.mode=="eager": return module
+        if self.mode=="compile": return torch.compile(module)
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore", torch.jit.TracerWarning)
+            warnings.simplefilter("ignore", FutureWarning)
+            return torch.jit.freeze(torch.jit.trace(module.eval(), example, check_trace=False))
+
+    def _score(self, images:torch.Tensor) -> torch.Tensor:
+        # straight through the backbone and head, without the FeatureMemo
+        with torch.no_grad():
+            return torch.cat(list(self.head(self.feature_extractor._get_image_features_batch(images[i:i+self.batch_size]))
+                                  for i in range(0, len(images), self.batch_size)))
+
+    def evaluate_images(self, images:torch.Tensor) -> torch.Tensor:
+        '''
+        Scores for a [B,H,W,C] IMAGE tensor
+        '''
+        with torch.no_grad():
+            features = self.feature_extractor.get_image_features_batch(images.cpu(), batch_size=self.batch_size)
+            return torch.cat(list(self.head(features[i:i+self.batch_size]) for i in range(0, len(features), self.batch_size)))
+
+    def evaluate_files(self, files:list, output_value=0, workers:int=None) -> torch.Tensor:
+        '''
+        Scores for image files, which are decoded on a thread pool and run through the backbone batch_size at a time
+        (going through the feature cache, if the feature extractor uses one)
+        '''
+        fe = self.feature_extractor
+        with torch.no_grad():
+            if fe.use_cache:
+                fe.precache(files, delete_model=False, batch_size=self.batch_size, workers=workers)
+                scores = torch.cat(list(self.head(torch.stack(list(fe.get_features_from_file(f, device="cpu") for f in files[i:i+self.batch_size])))
+                                        for i in range(0, len(files), self.batch_size)))
+            else:
+                scores = torch.cat(list(self.head(features) for _, features in fe.features_from_files(files, batch_size=self.batch_size, workers=workers)))
+        return scores[:,output_value] if output_value is not None else scores
+
+    def benchmark(self, number_of_images:int=64, size:int=512, warmup:int=2) -> float:
+        '''
+        Images per second scored from random [number_of_images,size,size,3] batches (preprocessing, backbone and head)
+        '''
+        images = torch.rand((number_of_images, size, size, 3))
+        for _ in range(warmup): self._score(images[:self.batch_size])
+        start = time.perf_counter()
+        self._score(images)
+        return number_of_images / (time.perf_counter() - start)
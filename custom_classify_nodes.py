@@ -3,9 +3,9 @@ from transformers import AutoModelForImageClassification, AutoImageProcessor
 from PIL import Image
 import os, json
 import numpy as np
-from server import PromptServer
 import folder_paths
 import comfy.model_management
+from .message_bus import MessageBus
 
 def create_probability_calculator(model_directory, labels=[]):
     model = AutoModelForImageClassification.from_pretrained(model_directory, output_hidden_states=True)
@@ -123,6 +123,6 @@ class ImageCategoryScorer(BaseClassifier):
     def func(self, classifier, images, category, node_id):
         probs = [self.get_probs(classifier, image).get(category,0) for image in images]
         text = ",".join(["{:>6.2f}".format(100*prob) for prob in probs])
-        PromptServer.instance.send_sync("cg.image_classify.textmessage", {"id": node_id, "message":text})
+        MessageBus.post_scores(node_id, probs, decimals=2, scale=100)
         return ( probs, text )
     
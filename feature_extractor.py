@@ -1,16 +1,16 @@
 import torch
+import torch.nn.functional as F
+import numpy as np
 from PIL import Image
-from safetensors.torch import save_file, load_file
-import os
+import os, inspect, weakref
+from collections import deque, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from torch._tensor import Tensor
-from transformers import AutoProcessor, CLIPModel, AutoTokenizer, CLIPTextModelWithProjection
-from tqdm import tqdm
+from .feature_store import FeatureStore
+from .feature_memo import FeatureMemo
+from .instrumentation import Stats
 
-try:
-    from aim.torch.models import AIMForImageClassification
-    from aim.torch.data import val_transforms
-except:
-    print("AIM not available - pip install git+https://git@github.com/apple/ml-aim.git if you want to use it")
+# transformers, tqdm and aim are imported when first needed, so they don't slow down ComfyUI startup
 
 # REALNAMES is used for downloading the (small) preprocessor file
 REALNAMES = {
@@ -20,6 +20,65 @@ REALNAMES = {
 class FeatureExtractorException(Exception):
     pass
 
+def default_device() -> str:
+    return "cuda" if torch.cuda.is_available() else "cpu"
+
+PRECISIONS = { "fp32":torch.float, "fp16":torch.half, "bf16":torch.bfloat16, "int8":torch.float }
+
+def apply_precision(module:torch.nn.Module, precision:str) -> torch.nn.Module:
+    '''
+    Convert module to precision in place; int8 is dynamic quantization of the Linear layers, which only runs on CPU
+    '''
+    if precision not in PRECISIONS: raise FeatureExtractorException(f"Unknown precision {precision}")
+    if precision=="int8": return torch.ao.quantization.quantize_dynamic(module.to("cpu"), {torch.nn.Linear}, dtype=torch.qint8, inplace=True)
+    return module.to(PRECISIONS[precision])
+
+class TensorImageProcessor:
+    '''
+    Torch version of the CLIP image processor (resize shortest edge, center crop, normalize) that works on 
+    whole [B,H,W,C] batches of 0-1 float images on the target device. Constants are read from the HuggingFace 
+    image processor config.
+    '''
+    MODES = { 0:"nearest", 2:"bilinear", 3:"bicubic" }
+
+    def __init__(self, image_processor):
+        size = image_processor.size
+        self.shortest_edge = size.get("shortest_edge", None)
+        self.size = None if self.shortest_edge else (size["height"], size["width"])
+        self.crop_size = (image_processor.crop_size["height"], image_processor.crop_size["width"])
+        self.do_resize = getattr(image_processor, "do_resize", True)
+        self.do_center_crop = getattr(image_processor, "do_center_crop", True)
+        self.do_normalize = getattr(image_processor, "do_normalize", True)
+        self.mode = self.MODES.get(int(getattr(image_processor, "resample", 3)), "bicubic")
+        self.mean = torch.tensor(image_processor.image_mean).view(1,-1,1,1)
+        self.std = torch.tensor(image_processor.image_std).view(1,-1,1,1)
+
+    def _output_size(self, h, w):
+        if self.size: return self.size
+        if h<=w: return (self.shortest_edge, int(self.shortest_edge * w / h))
+        return (int(self.shortest_edge * h / w), self.shortest_edge)
+
+    def __call__(self, images:torch.Tensor, device) -> torch.Tensor:
+        x = images.to(device=device, dtype=torch.float).permute(0,3,1,2)
+        if x.shape[1]==1: x = x.expand(-1,3,-1,-1)
+        x = x[:,:3,:,:]
+        if self.do_resize:
+            size = self._output_size(x.shape[2], x.shape[3])
+            if size != tuple(x.shape[2:]):
+                antialias = self.mode!="nearest"
+                x = F.interpolate(x, size=size, mode=self.mode, antialias=antialias, **({"align_corners":False} if antialias else {}))
+                x = x.clamp(0,1)
+        if self.do_center_crop:
+            top, left = (x.shape[2]-self.crop_size[0])//2, (x.shape[3]-self.crop_size[1])//2
+            x = x[:,:,top:top+self.crop_size[0],left:left+self.crop_size[1]]
+        if self.do_normalize:
+            x = (x - self.mean.to(x.device)) / self.std.to(x.device)
+        return x.contiguous()
+    
+    @staticmethod
+    def from_pil(image:Image) -> torch.Tensor:
+        return torch.from_numpy(np.array(image.convert("RGB"))).unsqueeze(0).to(torch.float) / 255.
+
 class FeatureExtractor:
     @classmethod
     def realname(cls, pretrained):
@@ -36,17 +95,31 @@ class FeatureExtractor:
             return Apple_FeatureExtractor(pretrained=pretrained, **kwargs)
         else:
             return Transformers_FeatureExtractor(pretrained=pretrained, **kwargs)
+        
+    @classmethod
+    def backbone_key(cls, ap_metadata:dict, precision="fp32") -> tuple:
+        '''
+        Identifies the feature extractor an AestheticPredictor with this metadata needs; heads with the same key can share one
+        '''
+        hidden_states = ap_metadata.get('hidden_states', None) or []
+        if isinstance(hidden_states,str): hidden_states = list(int(x) for x in hidden_states[1:-1].split(',') if x)
+        return (ap_metadata["feature_extractor_model"], tuple(hidden_states), int(ap_metadata.get('weight_n_output_layers', None) or 0), precision)
 
-    def __init__(self, pretrained, device="cuda", image_directory=".", use_cache=True, base_directory=".", hidden_states=None, return_n_output_layers=None):
+    def __init__(self, pretrained, device=None, image_directory=".", use_cache=True, base_directory=".", hidden_states=None, return_n_output_layers=None, precision="fp32"):
         self.metadata = {"feature_extractor_model":pretrained if isinstance(pretrained,str) else "___".join(pretrained)}
-        self.device = device
+        self.device = device = device or default_device()
         self.image_directory = image_directory
         self.pretrained = pretrained
         self.model = None
         self.have_warned = False
         self.use_cache = use_cache
         self.base_directory = base_directory
-        self.dtype = torch.float
+        if precision not in PRECISIONS: raise FeatureExtractorException(f"Unknown precision {precision}")
+        if precision=="int8" and str(device)!="cpu": raise FeatureExtractorException("int8 precision is only available on the CPU")
+        self.precision = precision
+        self.dtype = PRECISIONS[precision]
+        self._last_batch = None
+        self.accelerated = None
         
         self.return_n_output_layers = return_n_output_layers
         if self.return_n_output_layers:
@@ -58,15 +131,15 @@ class FeatureExtractor:
 
         self.cached = {}
         if self.use_cache:
-            if os.path.exists(self.cachefile):
-                self.cached = load_file(self.cachefile, device=self.device)
-                if len(self.cached):
-                    print(f"Reloaded features from {self.cachefile} - delete this file if you don't want to do that")
-                    self.number_of_features = next(iter(self.cached.values())).shape[-1]
-                    return
-                else:
-                    self._load()
-            print(f"No feature cachefile found at {self.cachefile}")
+            self.cached = FeatureStore(self.storedirectory, precision=self.precision)
+            if not len(self.cached) and os.path.exists(self.cachefile):
+                print(f"Importing features from {self.cachefile} into {self.storedirectory}")
+                self.cached.import_safetensors(self.cachefile)
+            if len(self.cached):
+                print(f"Reloaded features from {self.storedirectory} - delete this directory if you don't want to do that")
+                self.number_of_features = self.cached.feature_shape[-1]
+                return
+            print(f"No feature cache found at {self.storedirectory}")
         self._load()
 
     def check_model(self, model):
@@ -75,42 +148,88 @@ class FeatureExtractor:
 
     @property
     def cachefile(self):
-        unique_name = self.pretrained if isinstance(self.pretrained, str) else "__".join(self.pretrained)
+        return self._cachefile(self.pretrained if isinstance(self.pretrained, str) else "__".join(self.pretrained))
+    
+    def _cachefile(self, unique_name):
+        if self.precision!="fp32": unique_name = unique_name + f"_{self.precision}"
         return os.path.join(self.image_directory,f"featurecache.{unique_name.replace('/','_').replace(':','_')}.safetensors")        
 
+    @property
+    def storedirectory(self):
+        return os.path.splitext(self.cachefile)[0]
+
     @property
     def model_path(self):
         return os.path.join(self.base_directory, self.pretrained)
     
-    def get_features_from_file(self, filepath, device="cuda", caching=False):
+    def get_features_from_file(self, filepath, device=None, caching=False):
         rel = os.path.relpath(filepath, self.image_directory)
         if not self.use_cache:
             return self._get_image_features_tensor(Image.open(filepath))
         if rel not in self.cached:
+            Stats.count("feature_cache_miss")
             if caching and not self.have_warned:
                 print("Getting features from file not in feature cache - precaching is likely to be faster!")
                 self.have_warned = True
             self.cached[rel] = self._get_image_features_tensor(Image.open(filepath))
-        return self.cached[rel].to(device).squeeze()
+        else:
+            Stats.count("feature_cache_hit")
+        with Stats.timer("feature_cache_read"): features = self.cached[rel]
+        with Stats.timer("to_device"): return features.to(device or self.device).squeeze()
     
-    def _cache_from_files(self, filepaths, device="cuda"):
+    def features_from_files(self, filepaths, batch_size=16, workers=None):
+        '''
+        Generator of (filepaths, features) batches, in order and bypassing the feature cache: the files are decoded and 
+        _prepared on a thread pool, keeping at most 2*batch_size of them in flight, and the backbone is run on batches 
+        of batch_size as they become ready
+        '''
+        if self.model is None: self._load()
+        def prepare(filepath):
+            with Image.open(filepath) as image: return self._prepare(image)
+        with ThreadPoolExecutor(workers or os.cpu_count()) as pool:
+            files = iter(filepaths)
+            in_flight = deque()
+            def submit():
+                filepath = next(files, None)
+                if filepath is not None: in_flight.append((filepath, pool.submit(prepare, filepath)))
+            for _ in range(2*batch_size): submit()
+            batch = []
+            while in_flight:
+                filepath, future = in_flight.popleft()
+                submit()
+                batch.append((filepath, future.result()))
+                if len(batch)==batch_size or not in_flight:
+                    with torch.no_grad(), Stats.timer("backbone"):
+                        features = self._features_from_prepared(list(prepared for _, prepared in batch))
+                    yield list(filepath for filepath, _ in batch), features
+                    batch = []
+
+    def _cache_from_files(self, filepaths, batch_size=16, workers=None, checkpoint_every=4096):
+        '''
+        Add the features of the files to the cache (see features_from_files), saving it every checkpoint_every files
+        '''
         if not self.use_cache: return
-        for filepath in tqdm(filepaths, desc=f"Caching {self.pretrained}"):
-            rel = os.path.relpath(filepath, self.image_directory)
-            self.cached[rel] = self.get_features_from_file(filepath, device, caching=True)
+        from tqdm import tqdm
+        filepaths = list(f for f in filepaths if os.path.relpath(f, self.image_directory) not in self.cached)
+        with tqdm(total=len(filepaths), desc=f"Caching {self.pretrained}") as progress:
+            for batch, features in self.features_from_files(filepaths, batch_size=batch_size, workers=workers):
+                for filepath, f in zip(batch, features): 
+                    self.cached[os.path.relpath(filepath, self.image_directory)] = f
+                if (progress.n // checkpoint_every) != ((progress.n + len(batch)) // checkpoint_every): self._save_cache()
+                progress.update(len(batch))
     
-    def precache(self, filepaths, delete_model=True):
+    def precache(self, filepaths, delete_model=True, batch_size=16, workers=None):
         if not self.use_cache: return
         self.have_warned = True
         newfiles = { f for f in filepaths if os.path.relpath(f, self.image_directory) not in self.cached }
         if newfiles:
-            self._cache_from_files(newfiles)
+            self._cache_from_files(newfiles, batch_size=batch_size, workers=workers)
             self._save_cache()
         if delete_model: self._delete_model()
 
     def _save_cache(self):
         if not self.use_cache: return
-        save_file(self.cached, self.cachefile)
+        self.cached.flush()
 
     def get_metadata(self):
         return self.metadata
@@ -118,6 +237,72 @@ class FeatureExtractor:
     def _get_image_features_tensor(self, image:Image) -> torch.Tensor:
         raise NotImplementedError()
     
+    @staticmethod
+    def _to_uint8(images:torch.Tensor) -> torch.Tensor:
+        return (255. * images).clamp(0, 255).to(torch.uint8)
+
+    def _get_image_features_batch(self, images:torch.Tensor) -> torch.Tensor:
+        '''
+        images is a [B,H,W,C] IMAGE tensor; returns the features with a leading batch dimension.
+        Subclasses that can run the backbone on a batch override this.
+        '''
+        with Stats.timer("pil_conversion"): pil_images = list(Image.fromarray(i) for i in self._to_uint8(images).cpu().numpy())
+        return torch.stack(list(self._get_image_features_tensor(i) for i in pil_images))
+    
+    @property
+    def identity(self) -> tuple:
+        return (type(self).__name__, self.metadata["feature_extractor_model"], tuple(self.hidden_states or []), self.return_n_output_layers or 0, self.precision)
+
+    def _prepare(self, image:Image):
+        '''
+        The per-image work (decoding, preprocessing) that can be done on a worker thread before batching
+        '''
+        return image.convert("RGB")
+    
+    def _features_from_prepared(self, prepared:list) -> torch.Tensor:
+        return torch.stack(list(self._get_image_features_tensor(p) for p in prepared))
+
+    def _memo_inputs(self, images:torch.Tensor) -> torch.Tensor:
+        '''
+        What the FeatureMemo hashes for a batch of images: equal inputs must give equal features, and smaller is faster.
+        Subclasses that preprocess on tensors return the preprocessed batch, and use it in _features_from_memo_inputs.
+        '''
+        return self._to_uint8(images)
+
+    def _features_from_memo_inputs(self, images:torch.Tensor, inputs:torch.Tensor) -> torch.Tensor:
+        return self._get_image_features_batch(images)
+
+    def get_image_features_batch(self, images:torch.Tensor, batch_size:int=8) -> torch.Tensor:
+        '''
+        Features for a [B,H,W,C] IMAGE tensor. The features of the most recent batch are kept, so other heads sharing this 
+        feature extractor don't rerun the backbone on the same images; otherwise images found in the FeatureMemo (if it
+        has a budget) are looked up, and the rest go through the backbone batch_size at a time.
+        '''
+        if self._last_batch and self._last_batch[0]() is images and self._last_batch[1]==images._version:
+            Stats.count("last_batch_reused")
+            return self._last_batch[2]
+        batch_size = batch_size or len(images)
+        if FeatureMemo.enabled():
+            inputs = torch.cat(list(self._memo_inputs(images[i:i+batch_size]) for i in range(0, len(images), batch_size)))
+            with Stats.timer("memo_lookup"):
+                keys = list((self.identity, digest) for digest in FeatureMemo.digests(inputs))
+                features = list(FeatureMemo.get(key) for key in keys)
+        else:
+            inputs, keys, features = None, None, [None]*len(images)
+        missing = list(i for i, f in enumerate(features) if f is None)
+        if keys:
+            Stats.count("memo_hit", len(features)-len(missing))
+            Stats.count("memo_miss", len(missing))
+        for j in range(0, len(missing), batch_size):
+            chunk = missing[j:j+batch_size]
+            computed = self._features_from_memo_inputs(images[chunk], inputs[chunk]) if keys else self._get_image_features_batch(images[chunk])
+            for i, f in zip(chunk, computed):
+                if keys: FeatureMemo.put(keys[i], f)
+                features[i] = f
+        with Stats.timer("to_device"): features = torch.stack(list(f.to(self.device) for f in features))
+        self._last_batch = (weakref.ref(images), images._version, features)
+        return features
+    
     def _load(self):
         raise NotImplementedError()
     
@@ -126,31 +311,88 @@ class FeatureExtractor:
         if not self.model or load_if_needed: return
         if self.model==None: self._load()
 
+    def managed_modules(self) -> list:
+        # int8 (dynamically quantized) models stay on the CPU, so aren't handed to comfy.model_management
+        return [self.model,] if self.model is not None and self.precision!="int8" else []
+
+    def resident_modules(self) -> list:
+        return [self.model,] if self.model is not None else []
+
     def _delete_model(self):
         if not self.model: return
         self.model.to('cpu')
         self.model = None
         self.processor = None
+        self.tensor_processor = None
+        self.accelerated = None
     
 class TextFeatureExtractor:
-    def __init__(self, pretrained, device="cuda"):
+    '''
+    Projected CLIP text embeddings, from the text tower alone (CLIPTextModelWithProjection). Prompts are tokenized together,
+    sorted by length and run batch_size at a time, each batch padded only to its longest prompt. Embeddings are kept 
+    in an LRU (per process, CG_CLASSIFIER_TEXT_CACHE_SIZE entries, default 16384) keyed by (prompt, clip_skip).
+
+    In get_text_features_batch, clip_skip None, 1 or -1 uses the final layer; n>1 (or -n) uses the output of the n-th layer
+    from the end (passed through the final layer norm and projection, as the final layer output is). 
+    get_text_features_tensor always uses the final layer, as it always has.
+    '''
+    cache_size = int(os.environ.get("CG_CLASSIFIER_TEXT_CACHE_SIZE", 16384))
+    cache = OrderedDict() # (pretrained, prompt, clip_skip) -> embedding (on the CPU)
+
+    def __init__(self, pretrained, device=None):
+        device = device or default_device()
         if isinstance(pretrained,list):
             assert len(pretrained)==1
             pretrained = pretrained[0]
-        self.model = CLIPModel.from_pretrained(pretrained, cache_dir="models")
+        from transformers import CLIPConfig, CLIPTextModelWithProjection, AutoTokenizer
+        self.pretrained = pretrained
+        config = CLIPConfig.from_pretrained(pretrained, cache_dir="models")
+        config.text_config.projection_dim = config.projection_dim # text_config may only have the default
+        self.model = CLIPTextModelWithProjection.from_pretrained(pretrained, config=config.text_config, cache_dir="models").eval()
         self.tokenizer = AutoTokenizer.from_pretrained(FeatureExtractor.realname(pretrained), cache_dir="models")
         self.model.to(device)
         self.device = device
 
+    def _embed(self, input_ids:torch.Tensor, attention_mask:torch.Tensor, clip_skip:int=None) -> torch.Tensor:
+        clip_skip = abs(clip_skip or 1)
+        outputs = self.model(input_ids=input_ids, attention_mask=attention_mask, output_hidden_states=clip_skip>1)
+        if clip_skip==1: return outputs.text_embeds
+        text_model = self.model.text_model
+        eos_token_id = getattr(text_model, "eos_token_id", self.model.config.eos_token_id)
+        eos = input_ids.argmax(dim=-1) if eos_token_id==2 else (input_ids==eos_token_id).int().argmax(dim=-1)
+        hidden = text_model.final_layer_norm(outputs.hidden_states[-clip_skip])
+        return self.model.text_projection(hidden[torch.arange(len(hidden), device=hidden.device), eos])
+
+    def get_text_features_batch(self, texts:list, clip_skip:int=None, batch_size:int=64) -> torch.Tensor:
+        '''
+        Embeddings of a list of prompts, [len(texts), number_of_features]
+        '''
+        clip_skip = abs(clip_skip or 1)
+        keys = list((self.pretrained, text, clip_skip) for text in texts)
+        missing = list(dict.fromkeys(k for k in keys if k not in self.cache))
+        if missing:
+            max_length = min(self.tokenizer.model_max_length, self.model.config.max_position_embeddings)
+            encoded = self.tokenizer(list(k[1] for k in missing), truncation=True, max_length=max_length)
+            order = sorted(range(len(missing)), key=lambda i: len(encoded["input_ids"][i]))
+            for j in range(0, len(order), batch_size):
+                chunk = order[j:j+batch_size]
+                batch = self.tokenizer.pad({ "input_ids":list(encoded["input_ids"][i] for i in chunk), 
+                                             "attention_mask":list(encoded["attention_mask"][i] for i in chunk) }, return_tensors="pt")
+                with torch.no_grad():
+                    embeddings = self._embed(batch["input_ids"].to(self.device), batch["attention_mask"].to(self.device), clip_skip).float().cpu()
+                for i, e in zip(chunk, embeddings): self.cache[missing[i]] = e
+        for k in keys: self.cache.move_to_end(k)
+        features = torch.stack(list(self.cache[k] for k in keys)).to(self.device)
+        while len(self.cache) > self.cache_size: self.cache.popitem(last=False)
+        return features
+
     def get_text_features_tensor(self, text:str, clip_skip:int=None):
-        text_inputs = self.tokenizer( text, padding="max_length", max_length=self.tokenizer.model_max_length, truncation=True, return_tensors="pt" )
-        text_input_ids = text_inputs.input_ids.to(self.device)
-        attention_mask = text_inputs.attention_mask.to(self.device)
-        return self.model.get_text_features(text_input_ids, attention_mask)
+        # clip_skip is accepted but, as before, ignored: callers get final layer embeddings. Use get_text_features_batch for clip_skip
+        return self.get_text_features_batch([text])
     
     @property
     def number_of_features(self):
-        return self.model.projection_dim
+        return self.model.config.projection_dim
    
 class Transformers_FeatureExtractor(FeatureExtractor):
     def __init__(self, **kwargs):
@@ -162,12 +404,16 @@ class Transformers_FeatureExtractor(FeatureExtractor):
         if self.hidden_states: self.metadata['hidden_states'] = "_".join(str(x) for x in self.hidden_states)
 
     def _load(self):
+        from transformers import AutoImageProcessor, CLIPModel
+        Stats.count("backbone_load")
         self.model = CLIPModel.from_pretrained(self.pretrained, cache_dir="models")
         self.number_of_features = self.model.projection_dim * (len(self.hidden_states) if self.hidden_states else 1)
         self.metadata['number_of_features'] = str(self.number_of_features)
         self.model.text_model = None
+        self.model = apply_precision(self.model, self.precision)
         self.model.to(self.device)
-        self.processor = AutoProcessor.from_pretrained(self.realname(self.pretrained), cache_dir="models")
+        self.processor = AutoImageProcessor.from_pretrained(self.realname(self.pretrained), cache_dir="models")
+        self.tensor_processor = TensorImageProcessor(self.processor)
 
     @property
     def cachefile(self):
@@ -176,43 +422,87 @@ class Transformers_FeatureExtractor(FeatureExtractor):
             unique_name = unique_name + "_" + "_".join(str(x) for x in self.hidden_states)
         if self.return_n_output_layers:
             unique_name = self.pretrained + f"_last{self.return_n_output_layers}"
-        return os.path.join(self.image_directory,f"featurecache.{unique_name.replace('/','_').replace(':','_')}.safetensors")     
-
-    def _get_image_features(self, pixel_values, hidden_state):
-        vision_outputs = self.model.vision_model(
-            pixel_values=pixel_values,
-            output_attentions=False,
-            output_hidden_states=True,
-            return_dict=True,
-        )
-        poolable = vision_outputs.hidden_states[-1-hidden_state][:,0,:]
-        pooled_output = self.model.vision_model.post_layernorm(poolable)
-        image_features = self.model.visual_projection(pooled_output)
-        return image_features.flatten()
+        return self._cachefile(unique_name)
+
+    def _project(self, class_token:torch.Tensor) -> torch.Tensor:
+        return self.model.visual_projection(self.model.vision_model.post_layernorm(class_token))
+    
+    @property
+    def number_of_encoder_layers(self):
+        return len(self.model.vision_model.encoder.layers)
+    
+    def _run_encoder_layer(self, layer, hidden:torch.Tensor) -> torch.Tensor:
+        # older transformers versions take (and return a tuple after) a causal_attention_mask
+        if "causal_attention_mask" in inspect.signature(layer.forward).parameters:
+            return layer(hidden, None, None)[0]
+        output = layer(hidden, None)
+        return output[0] if isinstance(output, tuple) else output
+
+    def _get_class_tokens(self, pixel_values, depths:list) -> dict:
+        '''
+        Run the vision tower only as far as the deepest of depths (0 is the embedding output, number_of_encoder_layers 
+        the final layer output), keeping just the class token of each layer in depths. Returns {depth:class_token}
+        '''
+        vision_model = self.model.vision_model
+        hidden = vision_model.pre_layrnorm(vision_model.embeddings(pixel_values))
+        class_tokens = { 0:hidden[:,0,:] } if 0 in depths else {}
+        for i, layer in enumerate(vision_model.encoder.layers[:max(depths)]):
+            hidden = self._run_encoder_layer(layer, hidden)
+            if i+1 in depths: class_tokens[i+1] = hidden[:,0,:]
+        return class_tokens
+
+    def _get_image_features(self, pixel_values, hidden_states:list):
+        '''
+        One (truncated) vision_model forward, projecting each of hidden_states (counted back from the last layer) and 
+        concatenating them in the order given
+        '''
+        depths = list(self.number_of_encoder_layers-x for x in hidden_states)
+        class_tokens = self._get_class_tokens(pixel_values, depths)
+        return torch.cat(tuple(self._project(class_tokens[d]) for d in depths), dim=1)
     
     def _get_image_features_n_layers(self, n, pixel_values):
-        vision_outputs = self.model.vision_model(
-            pixel_values=pixel_values,
-            output_attentions=False,
-            output_hidden_states=True,
-            return_dict=True,
-        )
-        image_features = torch.cat(list(self.model.visual_projection(self.model.vision_model.post_layernorm(x[:,0,:])) for x in vision_outputs.hidden_states[-n:]))
-        return image_features
+        depths = list(range(self.number_of_encoder_layers-n+1, self.number_of_encoder_layers+1))
+        class_tokens = self._get_class_tokens(pixel_values, depths)
+        return torch.stack(list(self._project(class_tokens[d]) for d in depths), dim=1)
+
+    def _backbone_forward(self, pixel_values) -> torch.Tensor:
+        if self.return_n_output_layers:
+            return self._get_image_features_n_layers(self.return_n_output_layers, pixel_values)
+        return self._get_image_features(pixel_values, self.hidden_states or [0])
+
+    def _features_from_pixel_values(self, pixel_values) -> torch.Tensor:
+        # accelerated is a compiled replacement for _backbone_forward (see CPUEngine)
+        pixel_values = pixel_values.to(self.dtype)
+        return (self.accelerated or self._backbone_forward)(pixel_values).float()
 
     def _get_image_features_tensor(self, image:Image) -> torch.Tensor:
+        return self._get_image_features_batch(TensorImageProcessor.from_pil(image))[0]
+        
+    def _get_image_features_batch(self, images:torch.Tensor) -> torch.Tensor:
+        return self._features_from_memo_inputs(images, self._memo_inputs(images))
+
+    def _memo_inputs(self, images:torch.Tensor) -> torch.Tensor:
+        # the pixel_values, in the dtype the backbone runs in, so the memo key is exactly what the backbone sees
         if self.model==None: self._load()
-        with torch.no_grad():
-            inputs = self.processor(images=image, return_tensors="pt")
-            for k in inputs:
-                if isinstance(inputs[k],torch.Tensor): inputs[k] = inputs[k].to(self.device)
-            if self.return_n_output_layers:
-                return self._get_image_features_n_layers(self.return_n_output_layers, **inputs)
-            elif self.hidden_states:
-                outputs = torch.cat(tuple(self._get_image_features(**inputs, hidden_state=x) for x in self.hidden_states))
-            else:
-                outputs = self._get_image_features(**inputs, hidden_state=0)
-            return outputs.flatten()
+        with Stats.timer("preprocess"): return self.tensor_processor(images, self.device).to(self.dtype)
+
+    def _features_from_memo_inputs(self, images:torch.Tensor, pixel_values:torch.Tensor) -> torch.Tensor:
+        with torch.no_grad(), Stats.timer("backbone"): return self._features_from_pixel_values(pixel_values)
+        
+    def _prepare(self, image:Image) -> torch.Tensor:
+        return self.tensor_processor(TensorImageProcessor.from_pil(image), "cpu")[0]
+    
+    def _features_from_prepared(self, prepared:list) -> torch.Tensor:
+        return self._features_from_pixel_values(torch.stack(prepared).to(self.device))
+        
+    def preprocessing_difference(self, images:torch.Tensor) -> float:
+        '''
+        Maximum absolute difference between the pixel values from the tensor preprocessing and the HuggingFace processor
+        '''
+        if self.model==None: self._load()
+        arrays = list(self._to_uint8(images).cpu().numpy())
+        reference = self.processor(images=arrays, return_tensors="pt")['pixel_values'].to(self.device)
+        return float((self.tensor_processor(images, self.device) - reference).abs().max())
         
 class Apple_FeatureExtractor(FeatureExtractor):
     def __init__(self, **kwargs):
@@ -221,7 +511,12 @@ class Apple_FeatureExtractor(FeatureExtractor):
         super().__init__(**kwargs)
         
     def _load(self):
-        self.model = AIMForImageClassification.from_pretrained(self.model_path, cache_dir="models").to(self.device)
+        try:
+            from aim.torch.models import AIMForImageClassification
+            from aim.torch.data import val_transforms
+        except ImportError:
+            raise FeatureExtractorException("AIM not available - pip install git+https://git@github.com/apple/ml-aim.git if you want to use it")
+        self.model = apply_precision(AIMForImageClassification.from_pretrained(self.model_path, cache_dir="models"), self.precision).to(self.device)
         self.number_of_features = self.model.head.bn.num_features
         self.processor = val_transforms()
 
@@ -229,7 +524,7 @@ class Apple_FeatureExtractor(FeatureExtractor):
         if self.model==None: self._load()
         self.model.to(self.device)
         with torch.no_grad():
-            inp = self.processor(image).unsqueeze(0).to(self.device)
+            inp = self.processor(image).unsqueeze(0).to(self.device, self.dtype)
             _, image_features = self.model(inp)
             return image_features.to(torch.float).flatten()
         
@@ -240,6 +535,12 @@ class Multi_FeatureExtractor(FeatureExtractor):
 
     def _delete_model(self):
         for fe in self.feature_extractors: fe._delete_model()
+
+    def managed_modules(self) -> list:
+        return sum((fe.managed_modules() for fe in self.feature_extractors), [])
+
+    def resident_modules(self) -> list:
+        return sum((fe.resident_modules() for fe in self.feature_extractors), [])
         
     def _get_image_features_tensor(self, image: Image) -> Tensor:
         ift = None
@@ -248,6 +549,10 @@ class Multi_FeatureExtractor(FeatureExtractor):
             features = fe._get_image_features_tensor(image)
             ift = features if ift is None else torch.cat([ift,features])
         return ift
+    
+    def _get_image_features_batch(self, images:torch.Tensor) -> Tensor:
+        for fe in self.feature_extractors: fe._to(self.device)
+        return torch.cat(list(fe._get_image_features_batch(images) for fe in self.feature_extractors), dim=1)
 
     def _to(self, device:str, load_if_needed=True):
         for fe in self.feature_extractors: fe._to(device, load_if_needed)
@@ -0,0 +1,60 @@
+import hashlib, os
+from collections import OrderedDict
+import torch
+
+class FeatureMemo:
+    '''
+    Process-wide LRU of image features keyed by (feature extractor identity, hash of what the backbone is given), so an
+    image that has been seen before (rescored, or scored by another head on the same backbone) skips the backbone.
+    The hash is of the preprocessed input (224x224 pixel_values for CLIP, much smaller than the image) where the feature 
+    extractor provides one, and of the uint8 image otherwise. Bounded to budget bytes of features, set in MB by 
+    CG_CLASSIFIER_FEATURE_MEMO_MB; with a budget of 0 nothing is hashed or kept.
+    '''
+    budget = int(os.environ.get("CG_CLASSIFIER_FEATURE_MEMO_MB", 256)) * 1024 * 1024
+    entries:OrderedDict = OrderedDict()
+    size = 0
+    hits = 0
+    misses = 0
+
+    @classmethod
+    def enabled(cls) -> bool:
+        return cls.budget > 0
+
+    @staticmethod
+    def digests(inputs:torch.Tensor) -> list:
+        '''
+        A digest of each item of a batch, with one copy of the batch to the CPU. sha1 because it is about twice as fast
+        as blake2b (the digests aren't security sensitive)
+        '''
+        inputs = inputs.detach().contiguous().cpu()
+        prefix = f"{tuple(inputs.shape[1:])}{inputs.dtype}".encode()
+        rows = inputs.reshape(len(inputs), -1).view(torch.uint8).numpy()
+        return list(hashlib.sha1(prefix + row.tobytes(), usedforsecurity=False).digest() for row in rows)
+
+    @classmethod
+    def get(cls, key) -> torch.Tensor:
+        if key in cls.entries:
+            cls.hits += 1
+            cls.entries.move_to_end(key)
+            return cls.entries[key]
+        cls.misses += 1
+        return None
+
+    @classmethod
+    def put(cls, key, features:torch.Tensor):
+        if key in cls.entries: return
+        features = features.detach().to("cpu", copy=True)
+        cls.entries[key] = features
+        cls.size += features.numel() * features.element_size()
+        while cls.size > cls.budget and cls.entries:
+            _, dropped = cls.entries.popitem(last=False)
+            cls.size -= dropped.numel() * dropped.element_size()
+
+    @classmethod
+    def clear(cls):
+        cls.entries.clear()
+        cls.size = 0
+
+    @classmethod
+    def stats(cls) -> dict:
+        return { "entries":len(cls.entries), "bytes":cls.size, "budget":cls.budget, "hits":cls.hits, "misses":cls.misses }
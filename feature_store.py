@@ -0,0 +1,113 @@
+import os, json
+import numpy as np
+import torch
+
+def _exception(message:str) -> Exception:
+    from .feature_extractor import FeatureExtractorException # imported here, as feature_extractor imports this module
+    return FeatureExtractorException(message)
+
+class FeatureStore:
+    '''
+    Append-only on-disk feature cache, used in place of a dict of tensors.
+
+    Feature vectors are appended as raw float32 rows to shard files of ROWS_PER_SHARD rows, and the key -> (shard, row)
+    index is an append-only text file, so a flush only writes what is new. Shards are read through numpy memory maps,
+    so nothing is loaded (or moved to a device) until it is asked for. New features are held in memory until flush(),
+    which happens automatically every flush_every additions. The precision the backbone ran at is recorded in info.json.
+    '''
+    ROWS_PER_SHARD = 65536
+
+    def __init__(self, directory, flush_every=1024, precision="fp32"):
+        self.directory = directory
+        self.precision = precision
+        self.flush_every = flush_every
+        self.index = {}
+        self.pending = {}
+        self.maps = {}
+        self.current_shard = 0
+        self.feature_shape = None
+        if os.path.exists(self.infofile):
+            with open(self.infofile) as f: info = json.load(f)
+            self.feature_shape = tuple(info['shape'])
+            if info.get('precision', 'fp32')!=precision: 
+                raise _exception(f"Feature store {directory} was made at {info.get('precision', 'fp32')} precision, not {precision}")
+            with open(self.indexfile) as f:
+                for line in f:
+                    shard, row, key = line.rstrip("\n").split("\t", 2)
+                    self.index[key] = (int(shard), int(row))
+                    self.current_shard = max(self.current_shard, int(shard))
+
+    @property
+    def infofile(self): return os.path.join(self.directory, "info.json")
+
+    @property
+    def indexfile(self): return os.path.join(self.directory, "index.txt")
+
+    def shardfile(self, shard): return os.path.join(self.directory, f"shard_{shard:05}.bin")
+
+    @property
+    def row_bytes(self): return 4 * int(np.prod(self.feature_shape))
+
+    def __len__(self):
+        return len(self.index) + sum(1 for k in self.pending if k not in self.index)
+
+    def __contains__(self, key):
+        return key in self.pending or key in self.index
+
+    def keys(self):
+        return set(self.index) | set(self.pending)
+
+    def __getitem__(self, key) -> torch.Tensor:
+        if key in self.pending: return self.pending[key]
+        shard, row = self.index[key]
+        return torch.from_numpy(np.array(self._map(shard)[row]))
+
+    def __setitem__(self, key, value:torch.Tensor):
+        value = value.detach().to("cpu", torch.float32)
+        if self.feature_shape is None: self.feature_shape = tuple(value.shape)
+        if tuple(value.shape)!=self.feature_shape:
+            raise _exception(f"Feature shape {tuple(value.shape)} doesn't match the shape {self.feature_shape} of feature store {self.directory}")
+        self.pending[key] = value
+        if len(self.pending) >= self.flush_every: self.flush()
+
+    def _map(self, shard):
+        if shard not in self.maps:
+            self.maps[shard] = np.memmap(self.shardfile(shard), dtype=np.float32, mode='r').reshape((-1,) + self.feature_shape)
+        return self.maps[shard]
+
+    def _open_shard(self):
+        # rows written after the last index update (eg by an interrupted flush) are never indexed; a partial row is dropped
+        path = self.shardfile(self.current_shard)
+        if os.path.exists(path) and os.path.getsize(path) % self.row_bytes:
+            os.truncate(path, os.path.getsize(path) - os.path.getsize(path) % self.row_bytes)
+        self.maps.pop(self.current_shard, None)
+        f = open(path, 'ab')
+        f.seek(0, os.SEEK_END)
+        return f
+
+    def flush(self):
+        if not self.pending: return
+        os.makedirs(self.directory, exist_ok=True)
+        if not os.path.exists(self.infofile):
+            with open(self.infofile, 'w') as f: json.dump({'shape':list(self.feature_shape), 'dtype':'float32', 'precision':self.precision}, f)
+        locations = {}
+        f = self._open_shard()
+        for key, value in self.pending.items():
+            if f.tell() >= self.ROWS_PER_SHARD * self.row_bytes:
+                f.close()
+                self.current_shard += 1
+                f = self._open_shard()
+            locations[key] = (self.current_shard, f.tell() // self.row_bytes)
+            f.write(value.numpy().tobytes())
+        f.close()
+        with open(self.indexfile, 'a') as f:
+            for key, (shard, row) in locations.items(): f.write(f"{shard}\t{row}\t{key}\n")
+        self.index.update(locations)
+        self.pending = {}
+
+    def import_safetensors(self, filepath):
+        from safetensors import safe_open
+        with safe_open(filepath, framework="pt", device="cpu") as f:
+            for key in f.keys():
+                if key not in self: self[key] = f.get_tensor(key)
+        self.flush()
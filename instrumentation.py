@@ -0,0 +1,129 @@
+import os, time, threading, contextvars, functools, inspect
+from contextlib import contextmanager
+from collections import defaultdict
+import torch
+
+class Stats:
+    '''
+    Process-wide timers and counters, aggregated per node: the node executing (set by @timed) by its UNIQUE_ID, so two 
+    nodes of the same class are kept apart, with its class alongside. Work outside a node is under "other".
+    `with Stats.timer("backbone"):` adds the time taken to the stage, and Stats.count("memo_hit") adds to a counter;
+    counters named x_hit and x_miss also give a hit rate for x in snapshot().
+
+    Turned off with CG_CLASSIFIER_STATS=0. GPU work is asynchronous, so stage times on the GPU are only accurate with
+    CG_CLASSIFIER_STATS_SYNC=1, which synchronizes at the start and end of each timer.
+
+    profile_next(n) captures the next n node executions with torch.profiler, saving chrome traces in profile_directory.
+    '''
+    enabled = os.environ.get("CG_CLASSIFIER_STATS", "1")!="0"
+    synchronize = os.environ.get("CG_CLASSIFIER_STATS_SYNC", "0")=="1"
+    timers = defaultdict(lambda: [0, 0.0, 0.0]) # ((node id, class), stage) -> [calls, total seconds, max seconds]
+    counters = defaultdict(int)                 # ((node id, class), name) -> count
+    node = contextvars.ContextVar("cg_classifier_node", default=("other", None))
+    lock = threading.Lock()
+    profile_remaining = 0
+    profile_directory = None
+    traces = []
+
+    @classmethod
+    def _sync(cls):
+        if cls.synchronize and torch.cuda.is_available(): torch.cuda.synchronize()
+
+    @classmethod
+    @contextmanager
+    def timer(cls, stage:str):
+        if not cls.enabled:
+            yield
+            return
+        cls._sync()
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            cls._sync()
+            elapsed = time.perf_counter() - start
+            with cls.lock:
+                t = cls.timers[(cls.node.get(), stage)]
+                t[0] += 1
+                t[1] += elapsed
+                t[2] = max(t[2], elapsed)
+
+    @classmethod
+    def count(cls, name:str, n:int=1):
+        if not cls.enabled or not n: return
+        with cls.lock: cls.counters[(cls.node.get(), name)] += n
+
+    @classmethod
+    def snapshot(cls) -> dict:
+        with cls.lock:
+            timers, counters = dict((k, list(v)) for k, v in cls.timers.items()), dict(cls.counters)
+        nodes = {}
+        entry = lambda node: nodes.setdefault(str(node[0]), {"class":node[1], "timers":{}, "counters":{}, "hit_rates":{}})
+        for (node, stage), (calls, total, longest) in timers.items():
+            entry(node)["timers"][stage] = { "calls":calls, "total_ms":1000*total, "mean_ms":1000*total/calls, "max_ms":1000*longest }
+        for (node, name), n in counters.items():
+            entry(node)["counters"][name] = n
+        for node in nodes.values():
+            c = node["counters"]
+            for name in set(n.rsplit("_", 1)[0] for n in c if n.endswith("_hit") or n.endswith("_miss")):
+                hits, misses = c.get(name + "_hit", 0), c.get(name + "_miss", 0)
+                node["hit_rates"][name] = hits / (hits + misses)
+        return { "enabled":cls.enabled, "synchronized":cls.synchronize, "nodes":nodes,
+                 "profiling":{ "remaining":cls.profile_remaining, "traces":list(cls.traces) } }
+
+    @classmethod
+    def reset(cls):
+        with cls.lock:
+            cls.timers.clear()
+            cls.counters.clear()
+
+    @classmethod
+    def profile_next(cls, executions:int, directory:str):
+        cls.profile_directory = directory
+        cls.profile_remaining = executions
+
+    @classmethod
+    @contextmanager
+    def profiling(cls, name:str):
+        with cls.lock:
+            capture = cls.profile_remaining > 0
+            if capture: cls.profile_remaining -= 1
+        if not capture:
+            yield
+            return
+        activities = [torch.profiler.ProfilerActivity.CPU] + ([torch.profiler.ProfilerActivity.CUDA] if torch.cuda.is_available() else [])
+        with torch.profiler.profile(activities=activities, record_shapes=True) as profile:
+            yield
+        os.makedirs(cls.profile_directory, exist_ok=True)
+        filepath = os.path.join(cls.profile_directory, f"{name}_{time.strftime('%Y%m%d_%H%M%S')}_{len(cls.traces)}.json")
+        profile.export_chrome_trace(filepath)
+        cls.traces.append(filepath)
+
+def timed(clazz):
+    '''
+    Class decorator for nodes: each execution of FUNCTION is timed as the stage "total", the timers and counters used
+    during it are attributed to the node (by UNIQUE_ID, which is added to the hidden inputs as node_id if the node doesn't
+    already ask for it, and only passed on to FUNCTION if it takes node_id), and it is profiled if Stats.profile_next 
+    asked for it. Called without a node_id (outside ComfyUI), the class name stands in for it.
+    '''
+    name = clazz.__name__
+    function = getattr(clazz, clazz.FUNCTION)
+    takes_node_id = "node_id" in inspect.signature(function).parameters
+    input_types = clazz.INPUT_TYPES.__func__
+    def INPUT_TYPES(cls):
+        it = input_types(cls)
+        it.setdefault("hidden", {}).setdefault("node_id", "UNIQUE_ID")
+        return it
+    clazz.INPUT_TYPES = classmethod(functools.wraps(input_types)(INPUT_TYPES))
+
+    @functools.wraps(function)
+    def timed_function(self, *args, **kwargs):
+        node_id = kwargs.get("node_id", None) if takes_node_id else kwargs.pop("node_id", None)
+        token = Stats.node.set((node_id or name, name))
+        try:
+            with Stats.profiling(f"{name}_{node_id}" if node_id else name), Stats.timer("total"):
+                return function(self, *args, **kwargs)
+        finally:
+            Stats.node.reset(token)
+    setattr(clazz, clazz.FUNCTION, timed_function)
+    return clazz
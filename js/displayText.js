@@ -14,12 +14,19 @@ function displayMessage(message) {
 	this.onResize?.(this.size);
 };
 
+// scores arrive as base64 float32, to be formatted like python's f"{scale*score:>{width}.{decimals}f}"
+function formatScores(detail) {
+	const bytes = Uint8Array.from(atob(detail.scores), (c) => c.charCodeAt(0));
+	const scores = new Float32Array(bytes.buffer);
+	return Array.from(scores, (s) => (detail.scale*s).toFixed(detail.decimals).padStart(detail.width)).join(",");
+}
+
 app.registerExtension({
 	name: "cg.image_classify.textmessage",
     async setup() {
         function messageHandler(event) {
             const id = event.detail.id;
-            const message = event.detail.message;
+            const message = (event.detail.scores === undefined) ? event.detail.message : formatScores(event.detail);
             const node = app.graph._nodes_by_id[id];
             if (node && node.displayMessage) node.displayMessage(message);
             else (console.log(`node ${id} couldn't handle a message`));
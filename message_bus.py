@@ -0,0 +1,54 @@
+from server import PromptServer
+import os, time, base64, threading
+import numpy as np
+
+class MessageBus:
+    '''
+    Coalescing dispatcher for the "cg.image_classify.textmessage" messages shown by the display nodes. post() just records
+    the latest message for a node (replacing any that hasn't been sent yet); a background thread sends whatever is pending,
+    then waits CG_CLASSIFIER_MESSAGE_INTERVAL_MS (default 100) before sending again. So each node gets at most one message
+    per interval, stale messages are dropped, and send_sync is never called on the executor thread.
+
+    Lists of scores are sent as base64 float32 with formatting hints, and js/displayText.js formats them. A message that 
+    fails to send is reported and dropped; the thread carries on.
+    '''
+    EVENT = "cg.image_classify.textmessage"
+    interval = int(os.environ.get("CG_CLASSIFIER_MESSAGE_INTERVAL_MS", 100)) / 1000
+    pending = {} # node_id -> payload
+    lock = threading.Lock()
+    wake = threading.Event()
+    thread = None
+
+    @classmethod
+    def post(cls, node_id, message:str):
+        cls._post({"id":node_id, "message":message})
+
+    @classmethod
+    def post_scores(cls, node_id, scores, decimals=4, scale=1.0, width=6):
+        '''
+        Have the node display ",".join(f"{scale*score:>{width}.{decimals}f}")
+        '''
+        packed = base64.b64encode(np.asarray(scores, dtype=np.float32).tobytes()).decode("ascii")
+        cls._post({"id":node_id, "scores":packed, "decimals":decimals, "scale":scale, "width":width})
+
+    @classmethod
+    def _post(cls, payload:dict):
+        with cls.lock:
+            cls.pending[payload["id"]] = payload
+            if cls.thread is None:
+                cls.thread = threading.Thread(target=cls._run, name="MessageBus", daemon=True)
+                cls.thread.start()
+        cls.wake.set()
+
+    @classmethod
+    def _run(cls):
+        while True:
+            cls.wake.wait()
+            cls.wake.clear()
+            with cls.lock: pending, cls.pending = cls.pending, {}
+            for payload in pending.values():
+                try:
+                    PromptServer.instance.send_sync(cls.EVENT, payload)
+                except Exception as e:
+                    print(f"MessageBus failed to send a message for node {payload['id']}: {e}")
+            time.sleep(cls.interval)
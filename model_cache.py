@@ -0,0 +1,107 @@
+import os
+from collections import OrderedDict
+import torch
+import torch.nn as nn
+import comfy.model_management
+import comfy.model_patcher
+from .instrumentation import Stats
+
+MB = 1024*1024
+
+class ManagedModule(nn.Module):
+    '''
+    Holder that lets comfy.model_management move a module (ModelPatcher writes attributes such as `device`
+    onto the model, which HuggingFace models don't allow)
+    '''
+    def __init__(self, module:nn.Module, device):
+        super().__init__()
+        self.module = module
+        self.device = device
+
+class ModelCache:
+    '''
+    Process-wide LRU of loaded models, shared by all nodes. The modules of each entry (from value.managed_modules())
+    are registered with comfy.model_management, so ComfyUI moves them to the GPU when they are used and only offloads
+    them under memory pressure.
+
+    Entries are dropped (least recently used first) when their total size exceeds ram_budget, and our models are offloaded
+    when those on the GPU would exceed vram_budget. Both are set in MB by CG_CLASSIFIER_RAM_BUDGET_MB and
+    CG_CLASSIFIER_VRAM_BUDGET_MB.
+    '''
+    ram_budget = int(os.environ.get("CG_CLASSIFIER_RAM_BUDGET_MB", 8192)) * MB
+    vram_budget = int(os.environ.get("CG_CLASSIFIER_VRAM_BUDGET_MB", 4096)) * MB
+    entries:OrderedDict = OrderedDict() # key -> (value, [ModelPatcher,...], size in RAM, size of the managed modules)
+
+    @classmethod
+    def get(cls, key, loader:callable, modules:callable=None, resident:callable=None, keep:tuple=()):
+        '''
+        Return the cached value for key, creating it with loader() if needed. modules(value) gives the modules to 
+        manage (default value.managed_modules()), and resident(value) those whose size counts against the RAM budget
+        (default value.resident_modules() - which includes int8 models, that stay on the CPU unmanaged). Neither key 
+        nor the entries keep (others the caller is using) are evicted to make room for it.
+        '''
+        if key in cls.entries:
+            Stats.count("model_cache_hit")
+            cls.entries.move_to_end(key)
+        else:
+            Stats.count("model_cache_miss")
+            with Stats.timer("model_load"): value = loader()
+            modules = modules(value) if modules else value.managed_modules()
+            patchers = [ comfy.model_patcher.ModelPatcher(ManagedModule(m, comfy.model_management.unet_offload_device()),
+                                                          load_device=comfy.model_management.get_torch_device(),
+                                                          offload_device=comfy.model_management.unet_offload_device())
+                        for m in modules ]
+            resident = resident(value) if resident else value.resident_modules()
+            cls.entries[key] = (value, patchers, sum(cls.nbytes(m) for m in resident), sum(comfy.model_management.module_size(m) for m in modules))
+            cls._enforce_ram_budget(keep=(key,) + tuple(keep))
+        return cls.entries[key][0]
+
+    @staticmethod
+    def nbytes(module:nn.Module) -> int:
+        '''
+        Bytes of a module's parameters and buffers, including the packed weights of quantized layers (which aren't parameters)
+        '''
+        def size(v):
+            if isinstance(v, torch.Tensor): return v.numel() * v.element_size()
+            if isinstance(v, (tuple, list)): return sum(size(x) for x in v)
+            return 0
+        return sum(size(v) for v in module.state_dict().values())
+
+    @classmethod
+    def load_gpu(cls, *keys):
+        '''
+        Have comfy.model_management load the models of the entries keys to the GPU (a no-op if they are still there)
+        '''
+        cls._enforce_vram_budget(keys, sum(cls.entries[k][3] for k in keys))
+        with Stats.timer("load_gpu"): comfy.model_management.load_models_gpu(sum((cls.entries[k][1] for k in keys), []))
+
+    @classmethod
+    def _loaded(cls, patchers):
+        return list(lm for lm in comfy.model_management.current_loaded_models if lm.model in patchers)
+
+    @classmethod
+    def _unload(cls, patchers):
+        for lm in cls._loaded(patchers):
+            Stats.count("model_offload")
+            lm.model_unload()
+            comfy.model_management.current_loaded_models.remove(lm)
+
+    @classmethod
+    def _enforce_ram_budget(cls, keep=()):
+        while sum(e[2] for e in cls.entries.values()) > cls.ram_budget:
+            evictable = list(k for k in cls.entries if k not in keep)
+            if not evictable: break
+            _, patchers, _, _ = cls.entries.pop(evictable[0])
+            Stats.count("model_evict")
+            cls._unload(patchers)
+
+    @classmethod
+    def _enforce_vram_budget(cls, keys, size):
+        on_gpu = list(k for k in cls.entries if k not in keys and cls._loaded(cls.entries[k][1]))
+        while on_gpu and size + sum(cls.entries[k][3] for k in on_gpu) > cls.vram_budget:
+            cls._unload(cls.entries[on_gpu.pop(0)][1])
+
+    @classmethod
+    def clear(cls):
+        for _, patchers, _, _ in cls.entries.values(): cls._unload(patchers)
+        cls.entries.clear()
@@ -0,0 +1,98 @@
+import os, json
+import numpy as np
+
+class RunningStatistics:
+    '''
+    Constant-memory statistics of a stream of scores, updated a batch at a time with vectorized merges: count, mean and
+    variance (merged with Chan's formula), minimum and maximum, an exponentially weighted mean (weight ew_alpha for each
+    new score), and a histogram of a fixed number of bins from which quantiles are interpolated.
+
+    The histogram range is set by the first batch and doubled (merging pairs of bins) whenever a score falls outside it,
+    so quantiles are accurate to one bin width, about (max - min) / (bins / 2) at worst.
+    '''
+    def __init__(self, bins=2048, ew_alpha=0.01):
+        assert bins % 2 == 0
+        self.bins = bins
+        self.ew_alpha = ew_alpha
+        self.count = 0
+        self.mean = 0.0
+        self.M2 = 0.0
+        self.ew_mean = 0.0
+        self.minimum = None
+        self.maximum = None
+        self.low = 0.0
+        self.width = 0.0
+        self.histogram = np.zeros(bins, dtype=np.int64)
+
+    @property
+    def std(self) -> float:
+        return float(np.sqrt(self.M2 / self.count)) if self.count else 0.0
+
+    def update(self, scores):
+        x = np.asarray(scores, dtype=np.float64).ravel()
+        if not len(x): return self
+        n, batch_mean = len(x), float(x.mean())
+        ew_x = x
+        if not self.count:
+            self.width = max(float(x.max() - x.min()), 1e-6) / (self.bins // 2)
+            self.low = float(x.min()) - (self.bins // 4) * self.width
+            self.ew_mean, ew_x = float(x[0]), x[1:]
+            self.minimum, self.maximum = float(x.min()), float(x.max())
+
+        delta = batch_mean - self.mean
+        total = self.count + n
+        self.M2 += float(((x - batch_mean)**2).sum()) + delta**2 * self.count * n / total
+        self.mean += delta * n / total
+        self.count = total
+
+        decay = 1.0 - self.ew_alpha
+        self.ew_mean = self.ew_mean * decay**len(ew_x) + float((self.ew_alpha * decay**np.arange(len(ew_x)-1, -1, -1) * ew_x).sum())
+        self.minimum, self.maximum = min(self.minimum, float(x.min())), max(self.maximum, float(x.max()))
+
+        while self.minimum < self.low: self._double(downwards=True)
+        while self.maximum >= self.low + self.bins * self.width: self._double(downwards=False)
+        index = np.clip(((x - self.low) / self.width).astype(np.int64), 0, self.bins-1)
+        self.histogram += np.bincount(index, minlength=self.bins)
+        return self
+
+    def _double(self, downwards:bool):
+        merged = self.histogram.reshape(-1, 2).sum(axis=1)
+        self.histogram = np.zeros(self.bins, dtype=np.int64)
+        if downwards:
+            self.histogram[self.bins//2:] = merged
+            self.low -= self.bins * self.width
+        else:
+            self.histogram[:self.bins//2] = merged
+        self.width *= 2
+
+    def quantile(self, q:float) -> float:
+        if not self.count: return 0.0
+        cumulative = np.cumsum(self.histogram)
+        target = q * self.count
+        i = int(np.searchsorted(cumulative, target))
+        i = min(i, self.bins-1)
+        before = cumulative[i-1] if i else 0
+        fraction = (target - before) / self.histogram[i] if self.histogram[i] else 0.0
+        return float(np.clip(self.low + (i + fraction) * self.width, self.minimum, self.maximum))
+
+    def state_dict(self) -> dict:
+        return { "bins":self.bins, "ew_alpha":self.ew_alpha, "count":self.count, "mean":self.mean, "M2":self.M2,
+                 "ew_mean":self.ew_mean, "minimum":self.minimum, "maximum":self.maximum, "low":self.low, "width":self.width,
+                 "histogram":self.histogram.tolist() }
+
+    @classmethod
+    def from_state_dict(cls, state:dict) -> 'RunningStatistics':
+        statistics = cls(bins=state["bins"], ew_alpha=state["ew_alpha"])
+        for k in ("count", "mean", "M2", "ew_mean", "minimum", "maximum", "low", "width"): setattr(statistics, k, state[k])
+        statistics.histogram = np.asarray(state["histogram"], dtype=np.int64)
+        return statistics
+
+    def save(self, filepath):
+        os.makedirs(os.path.dirname(filepath), exist_ok=True)
+        with open(filepath + ".tmp", 'w') as f: json.dump(self.state_dict(), f)
+        os.replace(filepath + ".tmp", filepath)
+
+    @classmethod
+    def load(cls, filepath, **kwargs) -> 'RunningStatistics':
+        if not os.path.exists(filepath): return cls(**kwargs)
+        with open(filepath) as f: return cls.from_state_dict(json.load(f))
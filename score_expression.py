@@ -0,0 +1,92 @@
+import ast
+from functools import reduce
+import torch
+
+class ScoreExpressionException(Exception):
+    pass
+
+def _tensor(v) -> torch.Tensor:
+    return torch.as_tensor(v, dtype=torch.float64)
+
+def _max(*args): return reduce(torch.maximum, (_tensor(a) for a in args))
+def _min(*args): return reduce(torch.minimum, (_tensor(a) for a in args))
+def _where(c, a, b): return torch.where(_tensor(c)!=0, _tensor(a), _tensor(b))
+def _and(*args): return _tensor(reduce(torch.logical_and, (_tensor(a)!=0 for a in args)))
+def _or(*args): return _tensor(reduce(torch.logical_or, (_tensor(a)!=0 for a in args)))
+def _not(a): return _tensor(_tensor(a)==0)
+
+class ScoreExpression:
+    '''
+    An arithmetic expression in x, y (FLOATLISTs) and z (a FLOAT), such as "0.7*x + 0.3*max(y, z)", parsed and compiled
+    once and then evaluated on whole lists as float64 tensors, with z broadcast.
+
+    Allowed are numbers, + - * / // % **, comparisons (True is 1.0), `and`, `or`, `not`, `a if condition else b` and the
+    FUNCTIONS, all of which work elementwise.
+    '''
+    FUNCTIONS = {
+        "max":_max, "min":_min,
+        "abs":lambda a: torch.abs(_tensor(a)), "sqrt":lambda a: torch.sqrt(_tensor(a)),
+        "exp":lambda a: torch.exp(_tensor(a)), "log":lambda a: torch.log(_tensor(a)),
+        "sigmoid":lambda a: torch.sigmoid(_tensor(a)), "tanh":lambda a: torch.tanh(_tensor(a)),
+        "clamp":lambda a, low, high: _min(_max(a, low), high),
+        "where":_where,
+        "mean":lambda a: _tensor(a).mean(),
+    }
+    HELPERS = { "_tensor":_tensor, "_where":_where, "_and":_and, "_or":_or, "_not":_not }
+    VARIABLES = ("x", "y", "z")
+    NODES = ( ast.Expression, ast.BinOp, ast.UnaryOp, ast.Compare, ast.BoolOp, ast.IfExp, ast.Call, ast.Name, ast.Load, ast.Constant,
+              ast.Add, ast.Sub, ast.Mult, ast.Div, ast.FloorDiv, ast.Mod, ast.Pow, ast.USub, ast.UAdd, ast.Not, ast.And, ast.Or,
+              ast.Gt, ast.GtE, ast.Lt, ast.LtE, ast.Eq, ast.NotEq )
+
+    def __init__(self, expression:str):
+        self.expression = expression
+        try:
+            tree = ast.parse(expression.strip(), mode="eval")
+        except SyntaxError as e:
+            raise ScoreExpressionException(f"Can't parse '{expression}': {e.msg}")
+        for node in ast.walk(tree): self._check(node)
+        tree = ast.fix_missing_locations(_Vectorize().visit(tree))
+        self.code = compile(tree, "<score expression>", "eval")
+
+    def _check(self, node):
+        if not isinstance(node, self.NODES):
+            raise ScoreExpressionException(f"'{type(node).__name__}' isn't allowed in a score expression")
+        if isinstance(node, ast.Name) and node.id not in self.VARIABLES and node.id not in self.FUNCTIONS:
+            raise ScoreExpressionException(f"Unknown name '{node.id}' - use x, y, z or one of {', '.join(self.FUNCTIONS)}")
+        if isinstance(node, ast.Call) and (not isinstance(node.func, ast.Name) or node.func.id not in self.FUNCTIONS or node.keywords):
+            raise ScoreExpressionException(f"Only calls to {', '.join(self.FUNCTIONS)} (without keywords) are allowed")
+        if isinstance(node, ast.Constant) and (isinstance(node.value, bool) or not isinstance(node.value, (int, float))):
+            raise ScoreExpressionException(f"Only numbers are allowed as constants, not {node.value!r}")
+
+    def __call__(self, x, y=None, z=0.0) -> torch.Tensor:
+        x = _tensor(x)
+        variables = { "x":x, "y":_tensor(y) if y is not None else x, "z":_tensor(z) }
+        # torch's C code imports through the evaluating frame's builtins; _check means the expression itself can't reach them
+        result = eval(self.code, {"__builtins__":{"__import__":__import__}, **self.HELPERS, **self.FUNCTIONS}, variables)
+        return torch.broadcast_to(_tensor(result), x.shape)
+
+class _Vectorize(ast.NodeTransformer):
+    '''
+    Rewrites the parts of an expression that Python evaluates as a single truth value (if/else, and/or/not, chained
+    comparisons) as elementwise calls, and makes comparisons 0.0 or 1.0
+    '''
+    def _call(self, name, args):
+        return ast.Call(func=ast.Name(id=name, ctx=ast.Load()), args=args, keywords=[])
+
+    def visit_IfExp(self, node):
+        self.generic_visit(node)
+        return self._call("_where", [node.test, node.body, node.orelse])
+
+    def visit_BoolOp(self, node):
+        self.generic_visit(node)
+        return self._call("_and" if isinstance(node.op, ast.And) else "_or", node.values)
+
+    def visit_UnaryOp(self, node):
+        self.generic_visit(node)
+        return self._call("_not", [node.operand]) if isinstance(node.op, ast.Not) else node
+
+    def visit_Compare(self, node):
+        self.generic_visit(node)
+        lefts = [node.left] + node.comparators[:-1]
+        comparisons = list(self._call("_tensor", [ast.Compare(left=l, ops=[op], comparators=[r])]) for l, op, r in zip(lefts, node.ops, node.comparators))
+        return self._call("_and", comparisons) if len(comparisons)>1 else comparisons[0]
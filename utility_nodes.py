@@ -1,8 +1,28 @@
 from nodes import SaveImage
 from server import PromptServer
-import math
+from comfy.cli_args import args
+import folder_paths
+import os, json, threading
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from PIL import Image
+from PIL.PngImagePlugin import PngInfo
+from .score_expression import ScoreExpression
+from .running_statistics import RunningStatistics
+from .message_bus import MessageBus
+from .instrumentation import Stats, timed
+from aiohttp import web
 
+@timed
 class SaveIf(SaveImage):
+    '''
+    Save the first (mode "first") or every (mode "all") image whose score passes threshold (and optional_scores passes
+    optional_threshold), with SaveImage.save_images. With background_save the PNG encoding and metadata writing are done on a thread pool of 
+    CG_CLASSIFIER_SAVE_THREADS threads (default 2), with at most 4 images per thread waiting, and the UI result is returned
+    straight away - so the preview may not find a file that is still being written. File counters are reserved when the 
+    names are chosen, so saves still in progress can't collide. Files are written under a temporary name and renamed, so 
+    a partly written PNG is never seen.
+    '''
     @classmethod
     def INPUT_TYPES(s):
         it = super().INPUT_TYPES()
@@ -10,21 +30,86 @@ class SaveIf(SaveImage):
         it['required']['threshold'] = ("FLOAT", {"default":0.5, "step":0.001})
         it['optional'] = {
             "optional_scores" : ("FLOATLIST", {}),
-            "optional_threshold" : ("FLOAT", {"default":0.5, "step":0.001})
+            "optional_threshold" : ("FLOAT", {"default":0.5, "step":0.001}),
+            "mode" : (["first", "all"], {}),
+            "background_save" : ("BOOLEAN", {"default":False}),
         }
         return it
     FUNCTION = "func"
     CATEGORY = "CustomClassifier"
 
-    def func(self, scores, threshold, images, optional_scores=None, optional_threshold=None, **kwargs):
+    workers = int(os.environ.get("CG_CLASSIFIER_SAVE_THREADS", 2))
+    pool = ThreadPoolExecutor(workers, thread_name_prefix="SaveIf")
+    slots = threading.BoundedSemaphore(4*workers)
+    reserved = {} # (folder, filename) -> next free counter
+    lock = threading.Lock()
+
+    @classmethod
+    def reserve(cls, folder, filename, counter, number):
+        with cls.lock:
+            counter = max(counter, cls.reserved.get((folder, filename), 0))
+            cls.reserved[(folder, filename)] = counter + number
+        return counter
+
+    @staticmethod
+    def write(filepath, array, compress_level, prompt=None, extra_pnginfo=None):
+        metadata = None
+        if not args.disable_metadata:
+            metadata = PngInfo()
+            if prompt is not None: metadata.add_text("prompt", json.dumps(prompt))
+            for x in (extra_pnginfo or {}): metadata.add_text(x, json.dumps(extra_pnginfo[x]))
+        Image.fromarray(array).save(filepath + ".tmp", format="PNG", pnginfo=metadata, compress_level=compress_level)
+        os.replace(filepath + ".tmp", filepath)
+
+    @classmethod
+    def submit(cls, *args):
+        cls.slots.acquire()
+        future = cls.pool.submit(cls.write, *args)
+        def done(f):
+            cls.slots.release()
+            if f.exception(): print(f"SaveIf failed to save {args[0]}: {f.exception()}")
+        future.add_done_callback(done)
+
+    @classmethod
+    def wait(cls):
+        '''
+        Wait for the background saves in progress (save_images numbers files from those on disk, so would reuse their names)
+        '''
+        for _ in range(4*cls.workers): cls.slots.acquire()
+        for _ in range(4*cls.workers): cls.slots.release()
+
+    def func(self, scores, threshold, images, optional_scores=None, optional_threshold=None, mode="first", background_save=False, **kwargs):
         assert len(scores)==len(images)
-        for i, score in enumerate(scores):
-            if score>=threshold: 
-                if optional_scores is None or optional_threshold is None or optional_scores[i]>optional_threshold:
-                    return self.save_images(images[i].unsqueeze_(0), **kwargs)
-        return ()
+        passing = list( i for i, score in enumerate(scores) if score>=threshold and 
+                        (optional_scores is None or optional_threshold is None or optional_scores[i]>optional_threshold) )
+        if mode=="first": passing = passing[:1]
+        if not passing: return ()
+        if background_save: return self.save_in_background(images[passing], **kwargs)
+        self.wait()
+        return self.save_images(images[passing], **kwargs)
+
+    def save_in_background(self, images, filename_prefix="ComfyUI", prompt=None, extra_pnginfo=None, **kwargs):
+        full_output_folder, filename, counter, subfolder, filename_prefix = folder_paths.get_save_image_path(
+            filename_prefix + self.prefix_append, self.output_dir, images[0].shape[1], images[0].shape[0])
+        counter = self.reserve(full_output_folder, filename, counter, len(images))
+        results = []
+        for batch_number, image in enumerate(images):
+            file = f"{filename.replace('%batch_num%', str(batch_number))}_{counter+batch_number:05}_.png"
+            array = np.clip(255. * image.cpu().numpy(), 0, 255).astype(np.uint8)
+            self.submit(os.path.join(full_output_folder, file), array, self.compress_level, prompt, extra_pnginfo)
+            results.append({ "filename": file, "subfolder": subfolder, "type": self.type })
+        return { "ui": { "images": results } }
       
+@timed
 class ScoreOperations:
+    '''
+    Elementwise operations on FLOATLISTs x and y and a FLOAT z. Each operation, and the custom expression (used when operation 
+    is "expression"), is compiled to a ScoreExpression once and evaluated on the whole list.
+    '''
+    OPERATIONS = { "max(x,y)":"max(x,y)", "min(x,y)":"min(x,y)", "x+y":"x+y", "x-y":"x-y", "x*y":"x*y", "x/y":"x/y", 
+                   "x if y>z":"x if y>z else 0" }
+    COMPILED = { name:ScoreExpression(expression) for name, expression in OPERATIONS.items() }
+
     @classmethod
     def INPUT_TYPES(s):
         return {
@@ -32,9 +117,11 @@ class ScoreOperations:
                 "x":("FLOATLIST", {}),
                 "y":("FLOATLIST", {}),
                 "z":("FLOAT", {"default":0.0}),
-                "operation":(["max(x,y)", "min(x,y)", "x+y", "x-y", "x*y", "x/y", "x if y>z"],{})
+                "operation":(list(s.OPERATIONS) + ["expression"],{})
                 },
-            "optional":{}
+            "optional":{
+                "expression":("STRING", {"default":"0.7*x + 0.3*max(y, z)"}),
+            }
         }
     RETURN_TYPES = ("FLOATLIST",)
     RETURN_NAMES = ("result",)
@@ -42,20 +129,19 @@ class ScoreOperations:
     FUNCTION = "func"
     CATEGORY = "CustomClassifier"
 
-    def func(self,x,y,z,operation):
+    def __init__(self):
+        self.compiled = None
+
+    def func(self,x,y,z,operation,expression=""):
         assert len(x)==len(y)
-        r = []
-        for i,a in enumerate(x):
-            b = y[i]
-            if operation=="max(x,y)": r.append(max(a,b))
-            if operation=="min(x,y)": r.append(min(a,b))
-            if operation=="x+y": r.append(a+b)
-            if operation=="x-y": r.append(a-b)
-            if operation=="x*y": r.append(a*b)
-            if operation=="x/y": r.append(a/b)
-            if operation=="x if y>z" : r.append(a if b>z else 0)
-        return (r,)
+        if operation=="expression":
+            if self.compiled is None or self.compiled.expression!=expression: self.compiled = ScoreExpression(expression)
+            compiled = self.compiled
+        else:
+            compiled = self.COMPILED[operation]
+        return (compiled(x, y, z).tolist(),)
 
+@timed
 class ShowScores:
     FUNCTION = "func"
     CATEGORY = "CustomClassifier"
@@ -69,11 +155,16 @@ class ShowScores:
     RETURN_TYPES = ()
     
     def func(self, scores, node_id):
-        text = ",".join(["{:6.4f}".format(score) for score in scores])
-        PromptServer.instance.send_sync("cg.image_classify.textmessage", {"id": node_id, "message":text})
+        MessageBus.post_scores(node_id, scores, decimals=4)
         return ()
     
+@timed
 class RunningAverage:
+    '''
+    Mean, standard deviation, median, 10th and 90th percentiles and an exponentially weighted mean of all the scores 
+    seen, kept in a RunningStatistics (constant memory). The statistics are saved per node_id in the user directory 
+    after each update, and picked up again after a restart.
+    '''
     @classmethod
     def INPUT_TYPES(s):
         return {
@@ -83,35 +174,43 @@ class RunningAverage:
                     
     FUNCTION = "func"
     CATEGORY = "CustomClassifier"
-    RETURN_TYPES = ("FLOAT","STRING",)
-    RETURN_NAMES = ("Average","Av_string",)
+    RETURN_TYPES = ("FLOAT","STRING","FLOAT","FLOAT","FLOAT","FLOAT",)
+    RETURN_NAMES = ("Average","Av_string","Median","p10","p90","EW_average",)
     OUTPUT_NODE = True
 
+    @classmethod
+    def directory(cls):
+        return os.path.join(folder_paths.get_user_directory(), "cg_image_classify", "running_average")
+
     def __init__(self):
         self.node_id = 0
-        self.reset()
+        self.statistics = RunningStatistics()
+
+    @property
+    def filepath(self):
+        return os.path.join(self.directory(), f"{str(self.node_id).replace(os.sep,'_')}.json")
 
     def reset(self):
-        self.count = 0
-        self.mean = 0
-        self.Q = 0
-        if self.node_id: PromptServer.instance.send_sync("cg.image_classify.textmessage", {"id": self.node_id, "message":""})
+        self.statistics = RunningStatistics()
+        if self.node_id: 
+            if os.path.exists(self.filepath): os.remove(self.filepath)
+            MessageBus.post(self.node_id, "")
 
     def func(self, scores, mode, node_id):
         Messages.register(node_id,self)
-        self.node_id = node_id
-        old_mean = self.mean
-        
-        self.mean = (self.mean*self.count + sum(scores))/(self.count+len(scores))
-        self.Q += sum((x-old_mean)*(x-self.mean) for x in scores)
-        self.count += len(scores)
+        if self.node_id!=node_id:
+            self.node_id = node_id
+            self.statistics = RunningStatistics.load(self.filepath)
+        s = self.statistics.update(scores)
+        s.save(self.filepath)
         
+        median, p10, p90 = s.quantile(0.5), s.quantile(0.1), s.quantile(0.9)
         if mode=='percentage':
-            text = "{:>6.2f} +/- {:>6.2f} % ({:>3})".format(100*self.mean, 100*math.sqrt(self.Q/self.count), self.count)
+            text = "{:>6.2f} +/- {:>6.2f} % ({:>3})\nmedian {:>6.2f} [{:>6.2f}, {:>6.2f}] %".format(100*s.mean, 100*s.std, s.count, 100*median, 100*p10, 100*p90)
         else:
-            text = "{:>6.3f} +/- {:>6.2f} ({:>3})".format(self.mean, math.sqrt(self.Q/self.count), self.count)
-        PromptServer.instance.send_sync("cg.image_classify.textmessage", {"id": node_id, "message":text})
-        return (self.mean,"{:>6.3f}".format(self.mean),)
+            text = "{:>6.3f} +/- {:>6.2f} ({:>3})\nmedian {:>6.3f} [{:>6.3f}, {:>6.3f}]".format(s.mean, s.std, s.count, median, p10, p90)
+        MessageBus.post(node_id, text)
+        return (s.mean,"{:>6.3f}".format(s.mean),median,p10,p90,s.ew_mean,)
 
 class Messages:
     nodes = {}
@@ -121,6 +220,8 @@ class Messages:
     @classmethod
     def reset(cls):
         for nid in cls.nodes: cls.nodes[nid].reset()
+        if os.path.isdir(RunningAverage.directory()):
+            for f in os.listdir(RunningAverage.directory()): os.remove(os.path.join(RunningAverage.directory(), f))
 
 routes = PromptServer.instance.routes
 @routes.post('/image_classify_reset')
@@ -128,3 +229,24 @@ async def image_classify_reset(request):
     post = await request.post()
     Messages.reset()
 
+@routes.get('/image_classify_stats')
+async def image_classify_stats(request):
+    '''
+    Timers, counters and hit rates per node, keyed by UNIQUE_ID with the node class alongside (see instrumentation.Stats);
+    ?reset=1 clears them after reading
+    '''
+    snapshot = Stats.snapshot()
+    if request.query.get("reset", "0")!="0": Stats.reset()
+    return web.json_response(snapshot)
+
+@routes.post('/image_classify_profile')
+async def image_classify_profile(request):
+    '''
+    Capture the next `executions` (default 1) node executions with torch.profiler, as chrome traces in the user directory
+    '''
+    post = await request.post()
+    executions = int(post.get("executions", request.query.get("executions", 1)))
+    directory = os.path.join(folder_paths.get_user_directory(), "cg_image_classify", "profiles")
+    Stats.profile_next(executions, directory)
+    return web.json_response({"executions":executions, "directory":directory})
+